@@ -0,0 +1,77 @@
+#  Copyright 2018 Ocean Protocol Foundation
+#  SPDX-License-Identifier: Apache-2.0
+
+"""Compare the bulk throughput and index size of the mapping profiles.
+
+Every profile gets a scratch index loaded with the same generated DDOs, which
+is then refreshed and force merged before its store size is measured:
+
+    python -m benchmarks.mapping_profiles --host localhost:9200 --docs 20000
+"""
+
+import argparse
+import copy
+import time
+import uuid
+
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import streaming_bulk
+
+from oceandb_elasticsearch_driver.mapping import MAPPING_PROFILES, mapping_profile
+from tests.ddo_example import ddo_sample
+
+
+def ddos(n):
+    for i in range(n):
+        ddo = copy.deepcopy(ddo_sample)
+        ddo['id'] = f'did:op:{uuid.uuid4().hex}'
+        ddo['created'] = ddo['created'].isoformat()
+        ddo['proof']['signatureValue'] = uuid.uuid4().hex * 4
+        for key in ddo['publicKey']:
+            key['publicKeyPem'] = uuid.uuid4().hex * 8
+        ddo['service'][0]['attributes']['main']['name'] = f'Dataset {i}'
+        yield ddo
+
+
+def run(es, profile, n, chunk_size):
+    index = f'oceandb_benchmark_{profile}'
+    es.indices.delete(index=index, ignore=404)
+    body = mapping_profile(profile)
+    body['settings'].update(number_of_replicas=0)
+    es.indices.create(index=index, body=body)
+    actions = ({'_index': index, '_type': '_doc', '_id': ddo['id'], '_source': ddo} for ddo in ddos(n))
+    start = time.perf_counter()
+    for _ in streaming_bulk(es, actions, chunk_size=chunk_size):
+        pass
+    es.indices.refresh(index=index)
+    elapsed = time.perf_counter() - start
+    es.indices.forcemerge(index=index, max_num_segments=1)
+    stats = es.indices.stats(index=index, metric='store,segments')['indices'][index]['primaries']
+    fields = len(es.indices.get_field_mapping(index=index, fields='*')[index]['mappings']['_doc'])
+    es.indices.delete(index=index)
+    return {
+        'profile': profile,
+        'docs/s': round(n / elapsed),
+        'store MB': round(stats['store']['size_in_bytes'] / 2 ** 20, 2),
+        'segments memory KB': round(stats['segments']['memory_in_bytes'] / 2 ** 10, 1),
+        'mapped fields': fields,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='localhost:9200')
+    parser.add_argument('--docs', type=int, default=20000)
+    parser.add_argument('--chunk-size', type=int, default=500)
+    args = parser.parse_args()
+
+    es = Elasticsearch([args.host], timeout=120)
+    results = [run(es, profile, args.docs, args.chunk_size) for profile in MAPPING_PROFILES]
+    columns = list(results[0])
+    print('  '.join(f'{c:>20}' for c in columns))
+    for result in results:
+        print('  '.join(f'{result[c]!s:>20}' for c in columns))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,375 @@
+"""Asyncio implementation of OceanDB plugin based in Elasticsearch"""
+#  Copyright 2018 Ocean Protocol Foundation
+#  SPDX-License-Identifier: Apache-2.0
+
+import logging
+
+from elasticsearch.exceptions import ConflictError, NotFoundError
+from oceandb_driver_interface.plugin import AbstractPlugin
+from oceandb_driver_interface.search_model import FullTextModel, QueryModel
+
+from oceandb_elasticsearch_driver.instance import REFRESH_POLICIES, get_async_database_instance
+from oceandb_elasticsearch_driver.utils import (
+    is_hits_threshold,
+    list_body,
+    list_range,
+    log_slow_query,
+    mget_body,
+    page_result,
+    query_body,
+    query_sort,
+    query_text,
+    rejects_unmapped,
+    search_body,
+    sort_mapping,
+    sort_object,
+    source_filter,
+    text_query_body,
+    text_query_sort,
+    unknown_query_keys,
+    unmapped_sort_keys,
+    with_source_filter,
+    with_track_total_hits,
+)
+
+# Number of documents fetched per request while skipping to `search_from`.
+_SKIP_CHUNK_SIZE = 1000
+
+
+class AsyncPlugin(AbstractPlugin):
+    """Asyncio counterpart of :class:`~oceandb_elasticsearch_driver.plugin.Plugin`.
+
+    Every operation is a coroutine running on `AsyncElasticsearch`, and
+    :meth:`list` is an async generator, so the event loop is never blocked
+    on Elasticsearch I/O.
+    """
+
+    def __init__(self, config=None):
+        """Initialize a :class:`~.AsyncPlugin` instance. The connection to
+        Elasticsearch is established by the first awaited operation.
+        """
+        self.driver = get_async_database_instance(config)
+        self.logger = logging.getLogger('AsyncPlugin')
+        self._pending_refresh = False
+
+    @property
+    def type(self):
+        """str: the type of this plugin (``'Elasticsearch'``)"""
+        return 'Elasticsearch'
+
+    async def write(self, obj, resource_id=None, refresh=None):
+        """Write obj in elasticsearch.
+        :param obj: value to be written in elasticsearch.
+        :param resource_id: id for the resource.
+        :param refresh: refresh policy for this call, defaults to `db.refresh`.
+        :return: id of the transaction.
+        """
+        self.logger.debug('elasticsearch::write::%s', resource_id)
+        await self.driver.bootstrap()
+        try:
+            result = await self.driver.es.index(
+                index=self.driver.db_index,
+                id=resource_id,
+                body=obj,
+                doc_type='_doc',
+                op_type='create' if resource_id is not None else 'index',
+                refresh=self._refresh_param(refresh)
+            )
+        except ConflictError:
+            raise ValueError(
+                "Resource \"{}\" already exists, use update instead".format(resource_id))
+        return result['_id']
+
+    async def read(self, resource_id, fields=None, exclude=None):
+        """Read object in elasticsearch using the resource_id.
+        :param resource_id: id of the object to be read.
+        :param fields: list of fields to return, all by default.
+        :param exclude: list of fields to leave out of the returned object.
+        :return: object value from elasticsearch.
+        """
+        self.logger.debug('elasticsearch::read::%s', resource_id)
+        await self.driver.bootstrap()
+        if source_filter(fields, exclude) is None:
+            result = await self.driver.es.get(
+                index=self.driver.db_index,
+                id=resource_id,
+                doc_type='_doc'
+            )
+            return result['_source']
+        # The `_source` filtering parameters of the get API were renamed in
+        # Elasticsearch 6.6, a multi-get body filters on every version.
+        result = await self.driver.es.mget(
+            body=mget_body([resource_id], fields, exclude),
+            index=self.driver.db_index,
+            doc_type='_doc'
+        )
+        doc = result['docs'][0]
+        if not doc.get('found'):
+            raise NotFoundError(404, 'not_found', doc)
+        return doc.get('_source', {})
+
+    async def read_many(self, resource_ids, fields=None, exclude=None):
+        """Read many objects in elasticsearch in a single multi-get request.
+        :param resource_ids: ids of the objects to be read.
+        :param fields: list of fields to return, all by default.
+        :param exclude: list of fields to leave out of the returned objects.
+        :return: tuple with the list of objects, in the order of `resource_ids`
+            with None for the missing ones, and the list of missing ids.
+        """
+        resource_ids = list(resource_ids)
+        self.logger.debug('elasticsearch::read_many::%s', len(resource_ids))
+        if not resource_ids:
+            return [], []
+        await self.driver.bootstrap()
+        result = await self.driver.es.mget(
+            body=mget_body(resource_ids, fields, exclude),
+            index=self.driver.db_index,
+            doc_type='_doc'
+        )
+        object_list = []
+        missing = []
+        for resource_id, doc in zip(resource_ids, result['docs']):
+            if doc.get('found'):
+                object_list.append(doc.get('_source', {}))
+            else:
+                object_list.append(None)
+                missing.append(resource_id)
+        return object_list, missing
+
+    async def update(self, obj, resource_id, refresh=None):
+        """Update object in elasticsearch using the resource_id.
+        :param obj: new value
+        :param resource_id: id of the object to be updated.
+        :param refresh: refresh policy for this call, defaults to `db.refresh`.
+        :return: id of the object.
+        """
+        self.logger.debug('elasticsearch::update::%s', resource_id)
+        await self.driver.bootstrap()
+        result = await self.driver.es.index(
+            index=self.driver.db_index,
+            id=resource_id,
+            body=obj,
+            doc_type='_doc',
+            refresh=self._refresh_param(refresh)
+        )
+        return result['_id']
+
+    async def flush(self):
+        """Refresh the index if there are writes pending from the `deferred`
+        refresh policy, making them visible to searches.
+        """
+        if self._pending_refresh:
+            self.logger.debug('elasticsearch::flush')
+            self._pending_refresh = False
+            await self.driver.es.indices.refresh(index=self.driver.db_index)
+
+    def _refresh_param(self, refresh):
+        policy = refresh if refresh is not None else self.driver.refresh_policy
+        if policy not in REFRESH_POLICIES:
+            raise ValueError(f"Invalid refresh policy {policy}, use one of {list(REFRESH_POLICIES)}")
+        if policy == 'deferred':
+            self._pending_refresh = True
+        return REFRESH_POLICIES[policy]
+
+    async def delete_all(self):
+        q = '''{
+            "query" : {
+                "match_all" : {}
+            }
+        }'''
+        await self.driver.es.delete_by_query('_all', q)
+
+    async def delete(self, resource_id):
+        """Delete an object from elasticsearch.
+        :param resource_id: id of the object to be deleted.
+        :return:
+        """
+        self.logger.debug('elasticsearch::delete::%s', resource_id)
+        await self.driver.bootstrap()
+        try:
+            return await self.driver.es.delete(
+                index=self.driver.db_index,
+                id=resource_id,
+                doc_type='_doc'
+            )
+        except NotFoundError:
+            raise ValueError(f"Resource {resource_id} does not exists")
+
+    async def count(self, search_model: [QueryModel, FullTextModel] = None):
+        """Count the objects in elasticsearch.
+        :param search_model: object of QueryModel or FullTextModel, to only
+            count the objects matching it. All the objects by default.
+        :return: number of objects.
+        """
+        await self.driver.bootstrap()
+        kwargs = {}
+        if isinstance(search_model, FullTextModel):
+            kwargs['q'] = search_model.text
+        elif search_model is not None:
+            query = dict(search_model.query)
+            text = query_text(query)
+            if text:
+                # `_count` ignores `q` when there is a body, while a search
+                # replaces the query of the body with it: count what `query` runs.
+                kwargs['q'] = text
+            else:
+                kwargs['body'] = query_body(query, **await self._parser_options(query))
+        self.logger.debug('elasticsearch::count::%s', kwargs)
+        count_result = await self.driver.es.count(index=self.driver.db_index, **kwargs)
+        if count_result is not None and count_result['count'] > 0:
+            return count_result['count']
+
+        return 0
+
+    async def list(self, search_from=None, search_to=None, limit=None, chunk_size=100, fields=None,
+                   exclude=None):
+        """List all the objects saved in elasticsearch, paged in `_id` order
+        with `search_after`.
+
+         :param search_from: start offset of objects to return.
+         :param search_to: last offset of objects to return.
+         :param limit: max number of values to be returned.
+         :param chunk_size: int size of each batch of objects
+         :param fields: list of fields to return, all by default.
+         :param exclude: list of fields to leave out of the returned objects.
+         :return: async generator with all matching documents
+         """
+        self.logger.debug('elasticsearch::list')
+        await self.driver.bootstrap()
+        body = list_body(fields, exclude)
+        search_from, limit = list_range(search_from, search_to, limit)
+
+        search_after = None
+        skipped = 0
+        while skipped < search_from:
+            hits = await self._search_after(
+                body, min(search_from - skipped, _SKIP_CHUNK_SIZE), search_after, source=False)
+            if not hits:
+                return
+            skipped += len(hits)
+            search_after = hits[-1]['sort']
+
+        processed = 0
+        while limit is None or processed < limit:
+            size = chunk_size if limit is None else min(chunk_size, limit - processed)
+            hits = await self._search_after(body, size, search_after)
+            for x in hits:
+                yield x['_source']
+            processed += len(hits)
+            if len(hits) < size:
+                return
+            search_after = hits[-1]['sort']
+
+    async def _search_after(self, body, size, search_after=None, source=True):
+        body = dict(body, size=size)
+        if search_after is not None:
+            body['search_after'] = search_after
+        if not source:
+            body['_source'] = False
+        result = await self.driver.es.search(
+            index=self.driver.db_index,
+            body=body
+        )
+        log_slow_query(self.driver.slow_query_threshold, body, result)
+        return result['hits']['hits']
+
+    async def query(self, search_model: [QueryModel, FullTextModel], fields=None, exclude=None,
+                    track_total_hits=None):
+        """Query elasticsearch for objects.
+        :param search_model: object of QueryModel.
+        :param fields: list of fields to return, all by default.
+        :param exclude: list of fields to leave out of the returned objects.
+        :param track_total_hits: True to count the total hits exactly or False to
+            skip counting them. An int counts them up to that number, which needs
+            Elasticsearch 7.0 or later. Elasticsearch's default when None.
+        :return: tuple with the list of objects that match the query and the
+            total number of hits, None when they are not tracked.
+        """
+        assert search_model.page >= 1, 'page value %s is invalid' % search_model.page
+        if isinstance(search_model, FullTextModel):
+            return await self.text_query(search_model, fields, exclude, track_total_hits)
+
+        await self.driver.bootstrap()
+        text = query_text(search_model.query)
+        sort = query_sort(await self._sort_object(search_model.sort), text)
+        body = with_source_filter(
+            search_body(search_model.query, sort, search_model.page, search_model.offset,
+                        **await self._parser_options(search_model.query)),
+            fields, exclude)
+        await self._with_track_total_hits(body, track_total_hits)
+        self.logger.debug('elasticsearch::query::%s', body)
+        return await self._search_page(body, text)
+
+    async def text_query(self, search_model: FullTextModel, fields=None, exclude=None,
+                         track_total_hits=None):
+        """Query elasticsearch for objects.
+        :param search_model: object of FullTextModel
+        :param fields: list of fields to return, all by default.
+        :param exclude: list of fields to leave out of the returned objects.
+        :param track_total_hits: True to count the total hits exactly or False to
+            skip counting them. An int counts them up to that number, which needs
+            Elasticsearch 7.0 or later. Elasticsearch's default when None.
+        :return: tuple with the list of objects that match the query and the
+            total number of hits, None when they are not tracked.
+        """
+        assert search_model.page >= 1, 'page value %s is invalid' % search_model.page
+        self.logger.debug('elasticsearch::text_query::%s', search_model.text)
+        await self.driver.bootstrap()
+        sort = text_query_sort(await self._sort_object(search_model.sort))
+        body = text_query_body(search_model, sort, fields, exclude)
+        await self._with_track_total_hits(body, track_total_hits)
+        return await self._search_page(body, search_model.text)
+
+    async def close(self):
+        """Close the connections of the `AsyncElasticsearch` client of the running event loop."""
+        await self.driver.close()
+
+    async def _search_page(self, body, q=None):
+        page = await self.driver.es.search(
+            index=self.driver.db_index,
+            body=body,
+            q=q
+        )
+        log_slow_query(self.driver.slow_query_threshold, body, page)
+        return page_result(page)
+
+    async def _with_track_total_hits(self, body, track_total_hits):
+        cluster_version = await self.driver.cluster_version() if is_hits_threshold(track_total_hits) else None
+        return with_track_total_hits(body, track_total_hits, cluster_version)
+
+    async def _field_types(self, reload=False):
+        mapping_cache = self.driver.mapping_cache
+        if reload or mapping_cache.stale:
+            mapping_cache.load(await self.driver.es.indices.get_mapping(index=self.driver.db_index))
+        return mapping_cache
+
+    async def _parser_options(self, query):
+        """Options of `query_parser` for the field paths of `query`."""
+        keys = unknown_query_keys(query)
+        if not keys:
+            return {}
+        field_types = await self._field_types()
+        if rejects_unmapped(keys, field_types, self.driver.unknown_fields):
+            # The fields may have been mapped dynamically since the mapping was loaded.
+            field_types = await self._field_types(reload=True)
+        return {
+            'field_types': field_types,
+            'unknown_fields': self.driver.unknown_fields,
+        }
+
+    async def _mapping_to_sort(self, keys):
+        if not unmapped_sort_keys(keys, await self._field_types()):
+            return
+        # The fields may have been mapped dynamically since the mapping was loaded.
+        field_types = await self._field_types(reload=True)
+        for key in unmapped_sort_keys(keys, field_types, self.driver.unknown_fields):
+            await self.driver.es.indices.put_mapping(
+                index=self.driver.db_index, body=sort_mapping(key), doc_type='_doc')
+            field_types.invalidate()
+
+    async def _sort_object(self, sort):
+        """Sort clauses of the `sort` of a search model, None if it has none."""
+        if sort is None:
+            return None
+        await self._mapping_to_sort(sort.keys())
+        return sort_object(sort, await self._field_types())
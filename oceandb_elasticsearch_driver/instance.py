@@ -2,67 +2,261 @@
 #  SPDX-License-Identifier: Apache-2.0
 
 from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import ConnectionError as ClientConnectionError, RequestError
 from oceandb_driver_interface.utils import get_value
-from oceandb_elasticsearch_driver.mapping import mapping
+from oceandb_elasticsearch_driver.mapping import MAPPING_PROFILES, mapping_profile
+from oceandb_elasticsearch_driver.mapping_cache import MappingCache
+from oceandb_elasticsearch_driver.query_cache import QueryCache
+from oceandb_elasticsearch_driver.reindex import already_exists, bootstrap_index, reindex, versioned_index
+from oceandb_elasticsearch_driver.utils import UNKNOWN_FIELDS_POLICIES
+import asyncio
 import logging
+import os
+import threading
 import time
 
-_DB_INSTANCE = None
+try:
+    from elasticsearch_async import AsyncElasticsearch
+except ImportError:
+    AsyncElasticsearch = None
+
+# Instances are shared by all the plugins of a process with the same
+# resolved settings.
+_DB_INSTANCES = {}
+_ASYNC_DB_INSTANCES = {}
+_DB_INSTANCES_LOCK = threading.Lock()
+_DB_INSTANCES_PID = os.getpid()
+
+# Every `db.*` setting, with its environment variable and default value.
+_SETTINGS = (
+    ('db.hostname', 'DB_HOSTNAME', 'localhost'),
+    ('db.port', 'DB_PORT', 9200),
+    ('db.username', 'DB_USERNAME', None),
+    ('db.password', 'DB_PASSWORD', None),
+    ('db.index', 'DB_INDEX', 'oceandb'),
+    ('db.ssl', 'DB_SSL', 'false'),
+    ('db.verify_certs', 'DB_VERIFY_CERTS', 'false'),
+    ('db.ca_cert_path', 'DB_CA_CERTS', None),
+    ('db.client_key', 'DB_CLIENT_KEY', None),
+    ('db.client_cert_path', 'DB_CLIENT_CERT', None),
+    ('db.maxsize', 'DB_MAXSIZE', 1000),
+    ('db.timeout', 'DB_TIMEOUT', 10),
+    ('db.max_retries', 'DB_MAX_RETRIES', 3),
+    ('db.retry_on_timeout', 'DB_RETRY_ON_TIMEOUT', 'false'),
+    ('db.sniff_on_start', 'DB_SNIFF_ON_START', 'false'),
+    ('db.sniff_on_connection_fail', 'DB_SNIFF_ON_CONNECTION_FAIL', 'false'),
+    ('db.sniffer_timeout', 'DB_SNIFFER_TIMEOUT', None),
+    ('db.http_compress', 'DB_HTTP_COMPRESS', 'false'),
+    ('db.lazy_connect', 'DB_LAZY_CONNECT', 'true'),
+    ('db.startup_timeout', 'DB_STARTUP_TIMEOUT', 30),
+    ('db.skip_bootstrap', 'DB_SKIP_BOOTSTRAP', 'false'),
+    ('db.slow_query_threshold', 'DB_SLOW_QUERY_THRESHOLD', 0),
+    ('db.search_templates', 'DB_SEARCH_TEMPLATES', 'false'),
+    ('db.refresh', 'DB_REFRESH', 'wait_for'),
+    ('db.number_of_shards', 'DB_NUMBER_OF_SHARDS', None),
+    ('db.number_of_replicas', 'DB_NUMBER_OF_REPLICAS', None),
+    ('db.index_sort_field', 'DB_INDEX_SORT_FIELD', None),
+    ('db.index_sort_order', 'DB_INDEX_SORT_ORDER', 'desc'),
+    ('db.mapping_profile', 'DB_MAPPING_PROFILE', 'default'),
+    ('db.unknown_fields', 'DB_UNKNOWN_FIELDS', 'allow'),
+    ('db.mapping_cache_ttl', 'DB_MAPPING_CACHE_TTL', 300),
+    ('db.query_cache_size', 'DB_QUERY_CACHE_SIZE', 0),
+    ('db.query_cache_ttl', 'DB_QUERY_CACHE_TTL', 60),
+    ('db.query_cache_max_bytes', 'DB_QUERY_CACHE_MAX_BYTES', 64 * 1024 * 1024),
+)
+
+# Refresh policies accepted by `db.refresh`, mapped to the `refresh` parameter
+# of the index API. `deferred` does not refresh on write, the plugin issues a
+# single explicit refresh when it is flushed.
+REFRESH_POLICIES = {
+    'none': 'false',
+    'true': 'true',
+    'wait_for': 'wait_for',
+    'deferred': 'false',
+}
+
+# Orders accepted by `db.index_sort_order`.
+INDEX_SORT_ORDERS = ('asc', 'desc')
+
+# Bounds, in seconds, of the exponential backoff between connection attempts.
+_INITIAL_BACKOFF = 0.1
+_MAX_BACKOFF = 5
+
+# Request timeout, in seconds, of the pings made by `is_ready` and `health`.
+# They are sent by a client without retries, whose backoff between attempts
+# would block the caller for seconds.
+_PROBE_TIMEOUT = 1
 
 
 def get_database_instance(config_file=None):
-    global _DB_INSTANCE
-    if _DB_INSTANCE is None:
-        _DB_INSTANCE = ElasticsearchInstance(config_file)
+    return _get_instance(_DB_INSTANCES, ElasticsearchInstance, config_file)
 
-    return _DB_INSTANCE
 
+def get_async_database_instance(config_file=None):
+    return _get_instance(_ASYNC_DB_INSTANCES, AsyncElasticsearchInstance, config_file)
 
-class ElasticsearchInstance(object):
-    def __init__(self, config=None):
-        host = get_value('db.hostname', 'DB_HOSTNAME', 'localhost', config)
-        port = int(get_value('db.port', 'DB_PORT', 9200, config))
-        username = get_value('db.username', 'DB_USERNAME', None, config)
-        password = get_value('db.password', 'DB_PASSWORD', None, config)
-        index = get_value('db.index', 'DB_INDEX', 'oceandb', config)
-        ssl = self.str_to_bool(get_value('db.ssl', 'DB_SSL', 'false', config))
-        verify_certs = self.str_to_bool(
-            get_value('db.verify_certs', 'DB_VERIFY_CERTS', 'false', config)
-        )
-        ca_certs = get_value('db.ca_cert_path', 'DB_CA_CERTS', None, config)
-        client_key = get_value('db.client_key', 'DB_CLIENT_KEY', None, config)
-        client_cert = get_value('db.client_cert_path', 'DB_CLIENT_CERT', None, config)
-        self._index = index
-        try:
-            self._es = Elasticsearch(
-                [host],
-                http_auth=(username, password),
-                port=port,
-                use_ssl=ssl,
-                verify_certs=verify_certs,
-                ca_certs=ca_certs,
-                client_cert=client_key,
-                client_key=client_cert,
-                maxsize=1000
-            )
-            while self._es.ping() is False:
-                logging.info("Trying to connect...")
-                time.sleep(5)
-
-            self._es.indices.create(index=index, ignore=400, body=mapping)
 
-        except Exception as e:
-            logging.info(f"Exception trying to connect... {e}")
+def resolve_settings(config=None):
+    """dict with the value of every `db.*` setting, taken from the environment,
+    the `config` dict or its default."""
+    return {name: get_value(name, env_var, default, config) for name, env_var, default in _SETTINGS}
 
 
-    @property
-    def es(self):
-        return self._es
+def _get_instance(instances, instance_class, config_file):
+    global _DB_INSTANCES_LOCK, _DB_INSTANCES_PID
+    if _DB_INSTANCES_PID != os.getpid():
+        # The lock may have been held by another thread of the parent process
+        # when it forked. Instances rebuild their own connections.
+        _DB_INSTANCES_LOCK = threading.Lock()
+        _DB_INSTANCES_PID = os.getpid()
+
+    key = tuple((name, str(value)) for name, value in resolve_settings(config_file).items())
+    instance = instances.get(key)
+    if instance is None:
+        with _DB_INSTANCES_LOCK:
+            instance = instances.get(key)
+            if instance is None:
+                instance = instance_class(config_file)
+                instances[key] = instance
+
+    return instance
+
+
+def index_sort(fields, order='desc'):
+    """Index sorting settings for comma separated lists of `fields` and their
+    `order`, a single order applies to all the fields."""
+    fields = [f.strip() for f in str(fields).split(',') if f.strip()]
+    orders = [o.strip() for o in str(order).split(',') if o.strip()]
+    if len(orders) == 1:
+        orders = orders * len(fields)
+    if len(orders) != len(fields) or any(o not in INDEX_SORT_ORDERS for o in orders):
+        raise ValueError(
+            f"Invalid index sort order {order} for {fields}, use one of {list(INDEX_SORT_ORDERS)} per field")
+    return {'sort.field': fields, 'sort.order': orders}
+
+
+class _BaseInstance(object):
+    """Settings of an OceanDB config shared by the sync and async instances."""
+
+    def _read_config(self, config):
+        settings = resolve_settings(config)
+        host = settings['db.hostname']
+        port = int(settings['db.port'])
+        username = settings['db.username']
+        password = settings['db.password']
+        index = settings['db.index']
+        ssl = self.str_to_bool(settings['db.ssl'])
+        verify_certs = self.str_to_bool(settings['db.verify_certs'])
+        ca_certs = settings['db.ca_cert_path']
+        client_key = settings['db.client_key']
+        client_cert = settings['db.client_cert_path']
+        maxsize = int(settings['db.maxsize'])
+        timeout = float(settings['db.timeout'])
+        max_retries = int(settings['db.max_retries'])
+        retry_on_timeout = self.str_to_bool(settings['db.retry_on_timeout'])
+        sniff_on_start = self.str_to_bool(settings['db.sniff_on_start'])
+        sniff_on_connection_fail = self.str_to_bool(settings['db.sniff_on_connection_fail'])
+        sniffer_timeout = settings['db.sniffer_timeout']
+        http_compress = self.str_to_bool(settings['db.http_compress'])
+        lazy_connect = self.str_to_bool(settings['db.lazy_connect'])
+        startup_timeout = float(settings['db.startup_timeout'])
+        skip_bootstrap = self.str_to_bool(settings['db.skip_bootstrap'])
+        slow_query_threshold = float(settings['db.slow_query_threshold'])
+        search_templates = self.str_to_bool(settings['db.search_templates'])
+        refresh = settings['db.refresh']
+        if refresh not in REFRESH_POLICIES:
+            raise ValueError(f"Invalid refresh policy {refresh}, use one of {list(REFRESH_POLICIES)}")
+        number_of_shards = settings['db.number_of_shards']
+        number_of_replicas = settings['db.number_of_replicas']
+        index_sort_field = settings['db.index_sort_field']
+        index_sort_order = settings['db.index_sort_order']
+        profile = settings['db.mapping_profile']
+        if profile not in MAPPING_PROFILES:
+            raise ValueError(f"Invalid mapping profile {profile}, use one of {list(MAPPING_PROFILES)}")
+        unknown_fields = settings['db.unknown_fields']
+        if unknown_fields not in UNKNOWN_FIELDS_POLICIES:
+            raise ValueError(
+                f"Invalid unknown fields policy {unknown_fields}, use one of {list(UNKNOWN_FIELDS_POLICIES)}")
+        mapping_cache_ttl = float(settings['db.mapping_cache_ttl'])
+        query_cache_size = int(settings['db.query_cache_size'])
+        query_cache_ttl = float(settings['db.query_cache_ttl'])
+        query_cache_max_bytes = int(settings['db.query_cache_max_bytes'])
+        self._index = index
+        self._lazy_connect = lazy_connect
+        self._startup_timeout = startup_timeout
+        self._skip_bootstrap = skip_bootstrap
+        self._refresh_policy = refresh
+        self._search_templates = search_templates
+        self._slow_query_threshold = slow_query_threshold
+        self._mapping_profile = profile
+        self._unknown_fields = unknown_fields
+        self._index_settings = {}
+        if number_of_shards:
+            self._index_settings['number_of_shards'] = int(number_of_shards)
+        if number_of_replicas:
+            self._index_settings['number_of_replicas'] = int(number_of_replicas)
+        if index_sort_field:
+            self._index_settings['index'] = index_sort(index_sort_field, index_sort_order)
+        self._mapping_cache = MappingCache(mapping_cache_ttl)
+        self._query_cache = QueryCache(query_cache_size, query_cache_ttl, query_cache_max_bytes)
+        self._client_kwargs = dict(
+            # A comma separated list of hosts is load balanced round-robin.
+            hosts=[h.strip() for h in str(host).split(',') if h.strip()],
+            http_auth=(username, password),
+            port=port,
+            use_ssl=ssl,
+            verify_certs=verify_certs,
+            ca_certs=ca_certs,
+            client_cert=client_key,
+            client_key=client_cert,
+            maxsize=maxsize,
+            timeout=timeout,
+            max_retries=max_retries,
+            retry_on_timeout=retry_on_timeout,
+            sniff_on_start=sniff_on_start,
+            sniff_on_connection_fail=sniff_on_connection_fail,
+            sniffer_timeout=float(sniffer_timeout) if sniffer_timeout else None
+        )
+        if http_compress:
+            self._client_kwargs['http_compress'] = True
+        self._probe_kwargs = dict(self._client_kwargs, max_retries=0, sniff_on_start=False,
+                                  sniff_on_connection_fail=False, sniffer_timeout=None)
 
     @property
     def db_index(self):
         return self._index
 
+    @property
+    def index_body(self):
+        """Settings and mappings of a new version of the index."""
+        body = mapping_profile(self._mapping_profile)
+        body['settings'].update(self._index_settings)
+        return body
+
+    @property
+    def unknown_fields(self):
+        return self._unknown_fields
+
+    @property
+    def refresh_policy(self):
+        return self._refresh_policy
+
+    @property
+    def search_templates(self):
+        return self._search_templates
+
+    @property
+    def slow_query_threshold(self):
+        return self._slow_query_threshold
+
+    @property
+    def mapping_cache(self):
+        return self._mapping_cache
+
+    @property
+    def query_cache(self):
+        return self._query_cache
+
     @property
     def instance(self):
         return self
@@ -75,3 +269,224 @@ class ElasticsearchInstance(object):
             return False
         else:
             raise ValueError
+
+
+class ElasticsearchInstance(_BaseInstance):
+    """Connection to the Elasticsearch cluster and index of an OceanDB config.
+
+    Creating the client does not make any request. The cluster is contacted
+    and the index created the first time :attr:`es` is used (or on creation
+    when `db.lazy_connect` is false), retrying with exponential backoff for up
+    to `db.startup_timeout` seconds. If the cluster is still unreachable the
+    bootstrap is retried on later uses, without waiting. :meth:`is_ready` and
+    :meth:`health` never wait, they are meant for readiness probes.
+
+    `db.index` is an alias of the versioned index `<db.index>_v<N>` holding
+    the data, see :mod:`~oceandb_elasticsearch_driver.reindex`.
+
+    The connection pool is not shared with forked processes, the client is
+    rebuilt the first time it is used in a new process.
+    """
+
+    def __init__(self, config=None):
+        self._read_config(config)
+        self._es = Elasticsearch(**self._client_kwargs)
+        self._probe = Elasticsearch(**self._probe_kwargs)
+        self._pid = os.getpid()
+        self._ready = False
+        self._cluster_version = None
+        self._attempted = False
+        self._next_attempt = 0
+        self._lock = threading.Lock()
+        if not self._lazy_connect:
+            self._ensure_ready()
+
+    def _ensure_ready(self):
+        if self._ready:
+            return
+        with self._lock:
+            if self._ready or time.monotonic() < self._next_attempt:
+                return
+            self._bootstrap(0 if self._attempted else self._startup_timeout)
+
+    def _bootstrap(self, timeout):
+        deadline = time.monotonic() + timeout
+        delay = _INITIAL_BACKOFF
+        while True:
+            if self._try_bootstrap():
+                return
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            logging.info("Trying to connect...")
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, _MAX_BACKOFF)
+
+        self._attempted = True
+        self._next_attempt = time.monotonic() + _MAX_BACKOFF
+        logging.warning(f"Elasticsearch is not reachable, index {self._index} is not bootstrapped yet")
+
+    def _try_bootstrap(self):
+        # Errors other than connection ones, like an invalid index body, are
+        # raised: writes would otherwise create `db.index` with a dynamic mapping.
+        try:
+            if self._probe.ping(request_timeout=_PROBE_TIMEOUT):
+                if not self._skip_bootstrap:
+                    bootstrap_index(self._es, self._index, self.index_body)
+                self._ready = True
+        except ClientConnectionError as e:
+            logging.info(f"Exception trying to connect... {e}")
+        return self._ready
+
+    def is_ready(self):
+        """bool: whether the cluster answers a ping and the index is
+        bootstrapped. It makes a single attempt, without waiting for the
+        startup deadline of the first operation.
+        """
+        self._client()
+        # Do not wait for a bootstrap running in another thread.
+        if not self._ready and self._lock.acquire(blocking=False):
+            try:
+                if not self._ready:
+                    self._try_bootstrap()
+            except Exception as e:
+                logging.error(f"Index {self._index} can not be bootstrapped: {e}")
+            finally:
+                self._lock.release()
+        if not self._ready:
+            return False
+        try:
+            return self._probe.ping(request_timeout=_PROBE_TIMEOUT)
+        except Exception as e:
+            logging.info(f"Exception trying to connect... {e}")
+            return False
+
+    def health(self):
+        """Cluster health of the index, None if the cluster is not reachable.
+        It does not wait for the cluster nor bootstrap the index."""
+        try:
+            self._client()
+            return self._probe.cluster.health(index=self._index, request_timeout=_PROBE_TIMEOUT)
+        except Exception as e:
+            logging.info(f"Exception trying to connect... {e}")
+            return None
+
+    def reindex(self, **kwargs):
+        """Copy the data into a new version of the index, created with the
+        current mapping, and swap the `db.index` alias to it. The keyword
+        arguments are the ones of :func:`~oceandb_elasticsearch_driver.reindex.reindex`.
+        :return: name of the new index.
+        """
+        index = reindex(self.es, self._index, self.index_body, **kwargs)
+        self._mapping_cache.invalidate()
+        self._query_cache.clear()
+        return index
+
+    @property
+    def es(self):
+        es = self._client()
+        self._ensure_ready()
+        return es
+
+    def _client(self):
+        if self._pid != os.getpid():
+            self._after_fork()
+        return self._es
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._query_cache.after_fork()
+        self._es = Elasticsearch(**self._client_kwargs)
+        self._probe = Elasticsearch(**self._probe_kwargs)
+        self._pid = os.getpid()
+
+    @property
+    def cluster_version(self):
+        """int: major version of the Elasticsearch cluster."""
+        if self._cluster_version is None:
+            self._cluster_version = int(self.es.info()['version']['number'].split('.')[0])
+        return self._cluster_version
+
+
+class AsyncElasticsearchInstance(_BaseInstance):
+    """Asyncio counterpart of :class:`ElasticsearchInstance` backed by
+    `AsyncElasticsearch` from `elasticsearch-async`, the asyncio transport of
+    the 6.x client, so it does not change the version of the sync client.
+
+    No request is made on creation, the index is created by
+    :meth:`bootstrap` the first time the async plugin talks to the cluster.
+    The aiohttp session of a client is bound to the event loop it is created
+    in, so every running loop gets its own client, created on first use.
+    """
+
+    def __init__(self, config=None):
+        if AsyncElasticsearch is None:
+            raise ImportError(
+                'AsyncElasticsearch is not available, install oceandb-elasticsearch-driver[async]')
+        self._read_config(config)
+        self._clients = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._bootstrapped = self._skip_bootstrap
+        self._cluster_version = None
+
+    @property
+    def es(self):
+        """`AsyncElasticsearch` client of the running event loop."""
+        loop = asyncio.get_event_loop()
+        if self._pid != os.getpid():
+            self._lock = threading.Lock()
+            self._query_cache.after_fork()
+            self._clients = {}
+            self._pid = os.getpid()
+        es = self._clients.get(loop)
+        if es is None:
+            with self._lock:
+                # Clients of closed loops can not be used nor closed anymore.
+                self._clients = {other: client for other, client in self._clients.items()
+                                 if not other.is_closed()}
+                es = self._clients[loop] = AsyncElasticsearch(loop=loop, **self._client_kwargs)
+        return es
+
+    async def bootstrap(self):
+        if self._bootstrapped:
+            return
+        try:
+            if not await self.es.indices.exists(index=self._index):
+                await self.es.indices.create(index=versioned_index(self._index, 1),
+                                             body=dict(self.index_body, aliases={self._index: {}}))
+            self._bootstrapped = True
+        except RequestError as e:
+            if not already_exists(e):
+                raise
+            self._bootstrapped = True
+        except ClientConnectionError as e:
+            logging.info(f"Exception trying to connect... {e}")
+
+    async def is_ready(self):
+        try:
+            await self.bootstrap()
+            return self._bootstrapped and await self.es.ping()
+        except Exception as e:
+            logging.info(f"Exception trying to connect... {e}")
+            return False
+
+    async def health(self):
+        try:
+            return await self.es.cluster.health(index=self._index)
+        except Exception as e:
+            logging.info(f"Exception trying to connect... {e}")
+            return None
+
+    async def cluster_version(self):
+        """int: major version of the Elasticsearch cluster."""
+        if self._cluster_version is None:
+            info = await self.es.info()
+            self._cluster_version = int(info['version']['number'].split('.')[0])
+        return self._cluster_version
+
+    async def close(self):
+        """Close the client of the running event loop."""
+        es = self._clients.pop(asyncio.get_event_loop(), None)
+        if es is not None:
+            await es.transport.close()
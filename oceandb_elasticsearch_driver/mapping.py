@@ -1,6 +1,8 @@
 #  Copyright 2018 Ocean Protocol Foundation
 #  SPDX-License-Identifier: Apache-2.0
 
+import json
+
 mapping = '''
 {
   "settings": {
@@ -543,3 +545,42 @@ mapping = '''
     }
   }
 }'''
+
+MAPPING_PROFILES = ('default', 'lean')
+
+# DDO objects that are stored in `_source` but never searched, sorted nor
+# aggregated, and the string fields of the same kind.
+OPAQUE_OBJECTS = ('authentication', 'proof', 'publicKey')
+OPAQUE_STRINGS = ('@context', 'service.attributes.encryptedFiles')
+
+
+def mapping_profile(profile='default'):
+    """Index body, as a dict, of a mapping profile.
+
+    `default` is :data:`mapping`. `lean` does not index the opaque parts of the
+    DDO (keys, proofs, contexts and encrypted urls) and maps new string fields
+    to a single `keyword` instead of `text` plus a `keyword` subfield.
+    """
+    if profile not in MAPPING_PROFILES:
+        raise ValueError(f"Invalid mapping profile {profile}, use one of {list(MAPPING_PROFILES)}")
+    body = json.loads(mapping)
+    if profile == 'lean':
+        doc = body['mappings']['_doc']
+        for path in OPAQUE_OBJECTS:
+            _set_field(doc, path, {'type': 'object', 'enabled': False})
+        for path in OPAQUE_STRINGS:
+            _set_field(doc, path, {'type': 'keyword', 'index': False, 'doc_values': False})
+        doc['dynamic_templates'] = [{
+            'strings': {
+                'match_mapping_type': 'string',
+                'mapping': {'type': 'keyword', 'ignore_above': 256},
+            }
+        }]
+    return body
+
+
+def _set_field(doc, path, field):
+    *parents, name = path.split('.')
+    for parent in parents:
+        doc = doc['properties'][parent]
+    doc['properties'][name] = field
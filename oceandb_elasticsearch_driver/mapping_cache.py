@@ -0,0 +1,60 @@
+#  Copyright 2018 Ocean Protocol Foundation
+#  SPDX-License-Identifier: Apache-2.0
+
+import time
+
+
+class MappingCache(object):
+    """In-process copy of the field types of the index mapping.
+
+    It is loaded from a single `indices.get_mapping` response and maps every
+    field path, including multi-field subfields like `name.keyword`, to its
+    mapped type, so sort keys can be resolved without asking the cluster.
+    """
+
+    def __init__(self, ttl=300):
+        """
+        :param ttl: seconds after which the cache is considered stale, 0 or
+            None to keep it until it is invalidated.
+        """
+        self._ttl = ttl
+        self._types = None
+        self._loaded_at = None
+
+    @property
+    def stale(self):
+        if self._types is None:
+            return True
+        return bool(self._ttl) and time.monotonic() - self._loaded_at > self._ttl
+
+    def load(self, response):
+        """Replace the cached types with the ones in a `get_mapping` response."""
+        types = {}
+        for index_mapping in response.values():
+            mappings = index_mapping.get('mappings', {})
+            if 'properties' not in mappings:
+                # Mappings are still nested under the document type (`_doc`).
+                mappings = next(iter(mappings.values()), {})
+            self._add_properties(types, '', mappings.get('properties', {}))
+        self._types = types
+        self._loaded_at = time.monotonic()
+
+    def invalidate(self):
+        self._types = None
+
+    def field_type(self, key):
+        """Mapped type of the field path `key`, None if it is not mapped."""
+        if self._types is None:
+            return None
+        return self._types.get(key)
+
+    def __contains__(self, key):
+        return self.field_type(key) is not None
+
+    def _add_properties(self, types, prefix, properties):
+        for name, field in properties.items():
+            path = prefix + name
+            types[path] = field.get('type', 'object')
+            self._add_properties(types, path + '.', field.get('properties', {}))
+            for sub_name, sub_field in field.get('fields', {}).items():
+                types[path + '.' + sub_name] = sub_field.get('type')
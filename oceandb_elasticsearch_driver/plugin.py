@@ -2,13 +2,58 @@
 #  Copyright 2018 Ocean Protocol Foundation
 #  SPDX-License-Identifier: Apache-2.0
 
+import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
+from elasticsearch.exceptions import ConflictError, NotFoundError, RequestError
+from elasticsearch.helpers import scan, streaming_bulk
 from oceandb_driver_interface.plugin import AbstractPlugin
 from oceandb_driver_interface.search_model import FullTextModel, QueryModel
 
-from oceandb_elasticsearch_driver.instance import get_database_instance
-from oceandb_elasticsearch_driver.utils import query_parser
+from oceandb_elasticsearch_driver.instance import REFRESH_POLICIES, get_database_instance
+from oceandb_elasticsearch_driver.templates import (
+    query_shape,
+    template_id,
+    template_params,
+    template_source,
+)
+from oceandb_elasticsearch_driver.utils import (
+    facet_aggregations,
+    facet_results,
+    is_hits_threshold,
+    list_body,
+    list_range,
+    log_slow_query,
+    mget_body,
+    page_result,
+    patch_body,
+    query_body,
+    query_sort,
+    query_text,
+    rejects_unmapped,
+    search_body,
+    sort_mapping,
+    sort_object,
+    source_filter,
+    text_query_body,
+    text_query_sort,
+    unknown_query_keys,
+    unmapped_sort_keys,
+    with_source_filter,
+    with_track_total_hits,
+)
+
+# Number of documents fetched per request while skipping to `search_from`.
+_SKIP_CHUNK_SIZE = 1000
+
+# Index settings applied while in `bulk_load_mode`.
+_BULK_LOAD_SETTINGS = {
+    'index.refresh_interval': '-1',
+    'index.number_of_replicas': '0',
+    'index.translog.durability': 'async',
+}
 
 
 class Plugin(AbstractPlugin):
@@ -23,63 +68,330 @@ class Plugin(AbstractPlugin):
         """
         self.driver = get_database_instance(config)
         self.logger = logging.getLogger('Plugin')
-        logging.basicConfig(level=logging.INFO)
+        self._config = config
+        self._pending_refresh = False
+        self._bulk_load = False
+        self._stored_templates = set()
 
     @property
     def type(self):
         """str: the type of this plugin (``'Elasticsearch'``)"""
         return 'Elasticsearch'
 
-    def write(self, obj, resource_id=None):
+    def is_ready(self):
+        """bool: whether Elasticsearch is reachable and the index bootstrapped."""
+        return self.driver.is_ready()
+
+    @property
+    def query_cache(self):
+        """:class:`~.QueryCache` of `query` and `text_query` results, see
+        ``query_cache.stats()`` for its hit and miss counters."""
+        return self.driver.query_cache
+
+    def write(self, obj, resource_id=None, refresh=None):
         """Write obj in elasticsearch.
         :param obj: value to be written in elasticsearch.
         :param resource_id: id for the resource.
+        :param refresh: refresh policy for this call, defaults to `db.refresh`.
         :return: id of the transaction.
         """
-        self.logger.debug('elasticsearch::write::{}'.format(resource_id))
-        if resource_id is not None:
-            if self.driver.es.exists(
-                    index=self.driver.db_index,
-                    id=resource_id,
-                    doc_type='_doc'
-            ):
-                raise ValueError(
-                    "Resource \"{}\" already exists, use update instead".format(resource_id))
-
-        return self.driver.es.index(
-            index=self.driver.db_index,
-            id=resource_id,
-            body=obj,
-            doc_type='_doc',
-            refresh='wait_for'
-        )['_id']
+        self.logger.debug('elasticsearch::write::%s', resource_id)
+        try:
+            result = self.driver.es.index(
+                index=self.driver.db_index,
+                id=resource_id,
+                body=obj,
+                doc_type='_doc',
+                op_type='create' if resource_id is not None else 'index',
+                refresh=self._refresh_param(refresh)
+            )
+        except ConflictError:
+            raise ValueError(
+                "Resource \"{}\" already exists, use update instead".format(resource_id))
+        self.driver.query_cache.clear()
+        return result['_id']
 
-    def read(self, resource_id):
+    def read(self, resource_id, fields=None, exclude=None):
         """Read object in elasticsearch using the resource_id.
         :param resource_id: id of the object to be read.
+        :param fields: list of fields to return, all by default.
+        :param exclude: list of fields to leave out of the returned object.
         :return: object value from elasticsearch.
         """
-        self.logger.debug('elasticsearch::read::{}'.format(resource_id))
-        return self.driver.es.get(
+        self.logger.debug('elasticsearch::read::%s', resource_id)
+        if source_filter(fields, exclude) is None:
+            return self.driver.es.get(
+                index=self.driver.db_index,
+                id=resource_id,
+                doc_type='_doc'
+            )['_source']
+        # The `_source` filtering parameters of the get API were renamed in
+        # Elasticsearch 6.6, a multi-get body filters on every version.
+        doc = self.driver.es.mget(
+            body=mget_body([resource_id], fields, exclude),
             index=self.driver.db_index,
-            id=resource_id,
             doc_type='_doc'
-        )['_source']
-
-    def update(self, obj, resource_id):
+        )['docs'][0]
+        if not doc.get('found'):
+            raise NotFoundError(404, 'not_found', doc)
+        return doc.get('_source', {})
+
+    def read_many(self, resource_ids, fields=None, exclude=None):
+        """Read many objects in elasticsearch in a single multi-get request.
+        :param resource_ids: ids of the objects to be read.
+        :param fields: list of fields to return, all by default.
+        :param exclude: list of fields to leave out of the returned objects.
+        :return: tuple with the list of objects, in the order of `resource_ids`
+            with None for the missing ones, and the list of missing ids.
+        """
+        resource_ids = list(resource_ids)
+        self.logger.debug('elasticsearch::read_many::%s', len(resource_ids))
+        if not resource_ids:
+            return [], []
+        result = self.driver.es.mget(
+            body=mget_body(resource_ids, fields, exclude),
+            index=self.driver.db_index,
+            doc_type='_doc'
+        )
+        object_list = []
+        missing = []
+        for resource_id, doc in zip(resource_ids, result['docs']):
+            if doc.get('found'):
+                object_list.append(doc.get('_source', {}))
+            else:
+                object_list.append(None)
+                missing.append(resource_id)
+        return object_list, missing
+
+    def update(self, obj, resource_id, refresh=None):
         """Update object in elasticsearch using the resource_id.
         :param obj: new value
         :param resource_id: id of the object to be updated.
+        :param refresh: refresh policy for this call, defaults to `db.refresh`.
         :return: id of the object.
         """
-        self.logger.debug('elasticsearch::update::{}'.format(resource_id))
-        return self.driver.es.index(
+        self.logger.debug('elasticsearch::update::%s', resource_id)
+        result = self.driver.es.index(
             index=self.driver.db_index,
             id=resource_id,
             body=obj,
             doc_type='_doc',
-            refresh='wait_for'
-        )['_id']
+            refresh=self._refresh_param(refresh)
+        )
+        self.driver.query_cache.clear()
+        return result['_id']
+
+    def patch(self, resource_id, partial=None, upsert=False, script=None, if_seq_no=None,
+              if_primary_term=None, refresh=None):
+        """Update part of an object in elasticsearch with the update API, without
+        sending or reindexing the whole document from the client.
+        :param resource_id: id of the object to be updated.
+        :param partial: dict with the fields to change, merged into the object.
+        :param upsert: create the object from `partial` (or the upsert of
+            `script`) if it does not exist.
+        :param script: painless script applied instead of `partial`, as a dict
+            with `source` and optional `params`.
+        :param if_seq_no: only update if the object still has this sequence number.
+        :param if_primary_term: only update if the object still has this primary
+            term, required with `if_seq_no`.
+        :param refresh: refresh policy for this call, defaults to `db.refresh`.
+        :return: dict with the `_id`, `result`, `_seq_no` and `_primary_term` of
+            the updated object, to be used in the next conditional patch.
+        """
+        self.logger.debug('elasticsearch::patch::%s', resource_id)
+        if (if_seq_no is None) != (if_primary_term is None):
+            raise ValueError("if_seq_no and if_primary_term must be given together")
+        kwargs = {}
+        if if_seq_no is not None:
+            kwargs['if_seq_no'] = if_seq_no
+            kwargs['if_primary_term'] = if_primary_term
+        try:
+            result = self.driver.es.update(
+                index=self.driver.db_index,
+                id=resource_id,
+                body=patch_body(partial, upsert, script),
+                doc_type='_doc',
+                refresh=self._refresh_param(refresh),
+                **kwargs
+            )
+        except NotFoundError:
+            raise ValueError(f"Resource {resource_id} does not exists")
+        except ConflictError:
+            raise ValueError(
+                "Resource \"{}\" was modified concurrently, read it again".format(resource_id))
+        self.driver.query_cache.clear()
+        return {k: result.get(k) for k in ('_id', 'result', '_seq_no', '_primary_term')}
+
+    def patch_many(self, partials, upsert=False, chunk_size=500, max_chunk_bytes=100 * 1024 * 1024,
+                   refresh=None):
+        """Update part of many objects in elasticsearch using the bulk API.
+        :param partials: iterable of (resource_id, partial) pairs.
+        :param upsert: create the objects that do not exist from their partial.
+        :param chunk_size: max number of documents sent in one bulk request.
+        :param max_chunk_bytes: max size in bytes of one bulk request.
+        :param refresh: refresh policy for this call, defaults to `db.refresh`.
+        :return: list of (ok, result) tuples, one per document.
+        """
+        self.logger.debug('elasticsearch::patch_many')
+        actions = (
+            self._bulk_action('update', resource_id, patch_body(partial, upsert))
+            for resource_id, partial in partials
+        )
+        return self.bulk(actions, chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes,
+                         refresh=refresh)
+
+    def write_many(self, objs, chunk_size=500, max_chunk_bytes=100 * 1024 * 1024, refresh=None):
+        """Write many objects in elasticsearch using the bulk API.
+        :param objs: iterable of (resource_id, obj) pairs; resource_id may be None.
+        :param chunk_size: max number of documents sent in one bulk request.
+        :param max_chunk_bytes: max size in bytes of one bulk request.
+        :param refresh: refresh policy for this call, defaults to `db.refresh`.
+        :return: list of (ok, result) tuples, one per document.
+        """
+        self.logger.debug('elasticsearch::write_many')
+        actions = (
+            self._bulk_action('create' if resource_id is not None else 'index', resource_id, obj)
+            for resource_id, obj in objs
+        )
+        return self.bulk(actions, chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes,
+                         refresh=refresh)
+
+    def update_many(self, objs, chunk_size=500, max_chunk_bytes=100 * 1024 * 1024, refresh=None):
+        """Update many objects in elasticsearch using the bulk API.
+        :param objs: iterable of (resource_id, obj) pairs.
+        :param chunk_size: max number of documents sent in one bulk request.
+        :param max_chunk_bytes: max size in bytes of one bulk request.
+        :param refresh: refresh policy for this call, defaults to `db.refresh`.
+        :return: list of (ok, result) tuples, one per document.
+        """
+        self.logger.debug('elasticsearch::update_many')
+        actions = (
+            self._bulk_action('index', resource_id, obj)
+            for resource_id, obj in objs
+        )
+        return self.bulk(actions, chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes,
+                         refresh=refresh)
+
+    def delete_many(self, resource_ids, chunk_size=500, max_chunk_bytes=100 * 1024 * 1024,
+                    refresh=None):
+        """Delete many objects from elasticsearch using the bulk API.
+        :param resource_ids: iterable of ids of the objects to be deleted.
+        :param chunk_size: max number of documents sent in one bulk request.
+        :param max_chunk_bytes: max size in bytes of one bulk request.
+        :param refresh: refresh policy for this call, defaults to `db.refresh`.
+        :return: list of (ok, result) tuples, one per document.
+        """
+        self.logger.debug('elasticsearch::delete_many')
+        actions = (
+            self._bulk_action('delete', resource_id)
+            for resource_id in resource_ids
+        )
+        return self.bulk(actions, chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes,
+                         refresh=refresh)
+
+    def bulk(self, actions, chunk_size=500, max_chunk_bytes=100 * 1024 * 1024, refresh=None):
+        """Send bulk actions to elasticsearch in chunks and wait for all of them.
+
+        Actions are consumed lazily from the iterable and sent in `_bulk`
+        requests bounded by `chunk_size` documents and `max_chunk_bytes` bytes,
+        so the input is never fully loaded in memory. Failed items do not stop
+        the load; they are reported as `(False, result)`. Use :meth:`iter_bulk`
+        to process the results as they arrive instead of keeping them.
+
+        :param actions: iterable of actions in the `elasticsearch.helpers` format.
+        :param chunk_size: max number of documents sent in one bulk request.
+        :param max_chunk_bytes: max size in bytes of one bulk request.
+        :param refresh: refresh policy for this call, defaults to `db.refresh`.
+        :return: list of (ok, result) tuples, one per action.
+        """
+        return list(self.iter_bulk(actions, chunk_size, max_chunk_bytes, refresh))
+
+    def iter_bulk(self, actions, chunk_size=500, max_chunk_bytes=100 * 1024 * 1024, refresh=None):
+        """Generator version of :meth:`bulk`. Nothing is sent to elasticsearch
+        until it is iterated, and only the chunks whose results are consumed.
+        Cached query results are dropped when the iteration starts and when it ends.
+
+        :return: generator of (ok, result) tuples, one per action.
+        """
+        self.driver.query_cache.clear()
+        try:
+            yield from streaming_bulk(
+                self.driver.es,
+                actions,
+                chunk_size=chunk_size,
+                max_chunk_bytes=max_chunk_bytes,
+                raise_on_error=False,
+                refresh=self._refresh_param(refresh)
+            )
+        finally:
+            self.driver.query_cache.clear()
+
+    def flush(self):
+        """Refresh the index if there are writes pending from the `deferred`
+        refresh policy, making them visible to searches.
+        """
+        if self._pending_refresh:
+            self.logger.debug('elasticsearch::flush')
+            self._pending_refresh = False
+            self.driver.es.indices.refresh(index=self.driver.db_index)
+            self.driver.query_cache.clear()
+
+    def _refresh_param(self, refresh):
+        policy = refresh if refresh is not None else self.driver.refresh_policy
+        if policy not in REFRESH_POLICIES:
+            raise ValueError(f"Invalid refresh policy {policy}, use one of {list(REFRESH_POLICIES)}")
+        if policy == 'wait_for' and self._bulk_load:
+            # The index is not refreshed in bulk load mode, waiting would block.
+            policy = 'deferred'
+        if policy == 'deferred':
+            self._pending_refresh = True
+        return REFRESH_POLICIES[policy]
+
+    @contextmanager
+    def bulk_load_mode(self, force_merge=False, max_num_segments=1):
+        """Context manager tuning the index for a large ingest: refreshes are
+        disabled, replicas removed and the translog flushed asynchronously.
+
+        On exit, even if the block raises, the previous settings are restored,
+        the index is refreshed and, if `force_merge` is set, merged down to
+        `max_num_segments` segments. Writes with the `wait_for` refresh policy
+        are deferred to that refresh.
+
+        :param force_merge: force merge the index once the settings are restored.
+        :param max_num_segments: number of segments of the force merge.
+        """
+        es = self.driver.es
+        index = self.driver.db_index
+        previous = es.indices.get_settings(index=index, name=list(_BULK_LOAD_SETTINGS),
+                                           flat_settings=True)
+        self.logger.debug('elasticsearch::bulk_load_mode::%s', list(previous))
+        es.indices.put_settings(index=index, body=_BULK_LOAD_SETTINGS)
+        self._bulk_load = True
+        try:
+            yield self
+        finally:
+            self._bulk_load = False
+            for concrete_index, settings in previous.items():
+                # Settings that were not set explicitly are reset to their default.
+                es.indices.put_settings(index=concrete_index, body={
+                    name: settings['settings'].get(name) for name in _BULK_LOAD_SETTINGS
+                })
+            self._pending_refresh = True
+            self.flush()
+            if force_merge:
+                es.indices.forcemerge(index=index, max_num_segments=max_num_segments)
+
+    def _bulk_action(self, op_type, resource_id, obj=None):
+        action = {
+            '_op_type': op_type,
+            '_index': self.driver.db_index,
+            '_type': '_doc',
+        }
+        if resource_id is not None:
+            action['_id'] = resource_id
+        if obj is not None:
+            action['_source'] = obj
+        return action
 
     def delete_all(self):
         q = '''{
@@ -88,187 +400,433 @@ class Plugin(AbstractPlugin):
             }
         }'''
         self.driver.es.delete_by_query('_all', q)
+        self.driver.query_cache.clear()
 
     def delete(self, resource_id):
         """Delete an object from elasticsearch.
         :param resource_id: id of the object to be deleted.
         :return:
         """
-        self.logger.debug('elasticsearch::delete::{}'.format(resource_id))
-        if not self.driver.es.exists(
-                index=self.driver.db_index, id=resource_id, doc_type='_doc'):
+        self.logger.debug('elasticsearch::delete::%s', resource_id)
+        try:
+            result = self.driver.es.delete(
+                index=self.driver.db_index,
+                id=resource_id,
+                doc_type='_doc'
+            )
+        except NotFoundError:
             raise ValueError(f"Resource {resource_id} does not exists")
-        return self.driver.es.delete(
-            index=self.driver.db_index,
-            id=resource_id,
-            doc_type='_doc'
-        )
-
-    def count(self):
-        count_result = self.driver.es.count(index=self.driver.db_index)
+        self.driver.query_cache.clear()
+        return result
+
+    def count(self, search_model: [QueryModel, FullTextModel] = None):
+        """Count the objects in elasticsearch.
+        :param search_model: object of QueryModel or FullTextModel, to only
+            count the objects matching it. All the objects by default.
+        :return: number of objects.
+        """
+        kwargs = {}
+        if isinstance(search_model, FullTextModel):
+            kwargs['q'] = search_model.text
+        elif search_model is not None:
+            query = dict(search_model.query)
+            text = query_text(query)
+            if text:
+                # `_count` ignores `q` when there is a body, while a search
+                # replaces the query of the body with it: count what `query` runs.
+                kwargs['q'] = text
+            else:
+                kwargs['body'] = query_body(query, **self._parser_options(query))
+        self.logger.debug('elasticsearch::count::%s', kwargs)
+        count_result = self.driver.es.count(index=self.driver.db_index, **kwargs)
         if count_result is not None and count_result['count'] > 0:
             return count_result['count']
 
         return 0
 
-    def list(self, search_from=None, search_to=None, limit=None, chunk_size=100):
+    def list(self, search_from=None, search_to=None, limit=None, chunk_size=100, fields=None,
+             exclude=None):
         """List all the objects saved in elasticsearch
 
+        Documents are paged in `_id` order with `search_after`, so each chunk
+        costs the same regardless of its position and listing is not bounded
+        by `index.max_result_window`.
+
          :param search_from: start offset of objects to return.
          :param search_to: last offset of objects to return.
          :param limit: max number of values to be returned.
          :param chunk_size: int size of each batch of objects
+         :param fields: list of fields to return, all by default.
+         :param exclude: list of fields to leave out of the returned objects.
          :return: generator with all matching documents
          """
         self.logger.debug('elasticsearch::list')
-        _body = {
-            'sort': [
-                {"_id": "asc"},
-            ],
-            'query': {
-                'match_all': {}
-            }
-        }
-
-        count = 0
-        count_result = self.driver.es.count(index=self.driver.db_index)
-        if count_result is not None and count_result['count'] > 0:
-            count = count_result['count']
-
-        if not count:
-            return []
-
-        search_from = search_from if search_from is not None and search_from >= 0 else 0
-        search_from = min(search_from, count-1)
-        search_to = search_to if search_to is not None and search_to >= 0 else (count-1)
-        limit = search_to - search_from + 1
-        chunk_size = min(chunk_size, limit)
+        body = list_body(fields, exclude)
+        search_from, limit = list_range(search_from, search_to, limit)
+
+        search_after = None
+        skipped = 0
+        while skipped < search_from:
+            hits = self._search_after(
+                body, min(search_from - skipped, _SKIP_CHUNK_SIZE), search_after, source=False)
+            if not hits:
+                return
+            skipped += len(hits)
+            search_after = hits[-1]['sort']
 
-        _body['size'] = chunk_size
         processed = 0
-        while processed < limit:
-            body = _body.copy()
-            body['from'] = search_from
-            result = self.driver.es.search(
-                index=self.driver.db_index,
-                body=body
-            )
-            hits = result['hits']['hits']
-            search_from += len(hits)
-            processed += len(hits)
+        while limit is None or processed < limit:
+            size = chunk_size if limit is None else min(chunk_size, limit - processed)
+            hits = self._search_after(body, size, search_after)
             for x in hits:
                 yield x['_source']
+            processed += len(hits)
+            if len(hits) < size:
+                return
+            search_after = hits[-1]['sort']
+
+    def _search_after(self, body, size, search_after=None, source=True, q=None):
+        body = dict(body, size=size)
+        if search_after is not None:
+            body['search_after'] = search_after
+        if not source:
+            body['_source'] = False
+        result = self.driver.es.search(
+            index=self.driver.db_index,
+            body=body,
+            q=q
+        )
+        log_slow_query(self.driver.slow_query_threshold, body, result)
+        return result['hits']['hits']
 
-    def query(self, search_model: [QueryModel, FullTextModel]):
+    def query(self, search_model: [QueryModel, FullTextModel], fields=None, exclude=None,
+              track_total_hits=None):
         """Query elasticsearch for objects.
         :param search_model: object of QueryModel.
-        :return: list of objects that match the query.
+        :param fields: list of fields to return, all by default.
+        :param exclude: list of fields to leave out of the returned objects.
+        :param track_total_hits: True to count the total hits exactly or False to
+            skip counting them. An int counts them up to that number, which needs
+            Elasticsearch 7.0 or later. Elasticsearch's default when None.
+        :return: tuple with the list of objects that match the query and the
+            total number of hits, None when they are not tracked.
         """
         assert search_model.page >= 1, 'page value %s is invalid' % search_model.page
         if isinstance(search_model, FullTextModel):
-            return self.text_query(search_model)
-
-        text = None
-        query = search_model.query
-        if 'text' in query:
-            text = query.pop('text')
-
-        query_parsed = query_parser(search_model.query)
-        self.logger.debug(f'elasticsearch::query::{query_parsed}')
-        if search_model.sort is not None:
-            self._mapping_to_sort(search_model.sort.keys())
-            sort = self._sort_object(search_model.sort)
-        else:
-            sort = [{"_id": "asc"}]
-
-        if text:
-            sort = [{"_score": "desc"}] + sort
-            if isinstance(text, str):
-                text = [text]
-            text = [t.strip() for t in text]
-            text = [t.replace('did:op:', '0x') for t in text if t]
-
-        if search_model.query == {}:
-            query = {'match_all': {}}
-        else:
-            query = query_parsed
-
-        body = {
-            'sort': sort,
-            'from': (search_model.page - 1) * search_model.offset,
-            'size': search_model.offset,
-            'query': query
-        }
-
+            return self.text_query(search_model, fields, exclude, track_total_hits)
+
+        sort, text = self._query_sort_and_text(search_model)
+        shape = None
+        if self.driver.search_templates and not text and track_total_hits is None:
+            shape = query_shape(search_model.query)
+        if shape is not None:
+            _source = source_filter(fields, exclude)
+            params = template_params(
+                search_model.query, shape, sort, search_model.page, search_model.offset, _source)
+            try:
+                return self._search_template(shape, params, _source is not None)
+            except (NotFoundError, RequestError):
+                # The script may have been removed from the cluster since it was stored, store it again.
+                self._stored_templates.discard(template_id(shape, _source is not None))
+                return self._search_template(shape, params, _source is not None)
+
+        body = with_source_filter(
+            search_body(search_model.query, sort, search_model.page, search_model.offset,
+                        **self._parser_options(search_model.query)),
+            fields, exclude)
+        self._with_track_total_hits(body, track_total_hits)
+        self.logger.debug('elasticsearch::query::%s', body)
+        return self._search_page(body, text or None)
+
+    def facets(self, search_model: QueryModel, facets, size=10, ranges=None, interval='month',
+               include_hits=True, fields=None, exclude=None):
+        """Query elasticsearch for objects and count them per facet in the same request.
+        :param search_model: object of QueryModel.
+        :param facets: list of predefined query fields to count, like `categories`,
+            `license`, `tags`, `type`, `cost` or `datePublished`.
+        :param size: max number of values returned per exact-value facet.
+        :param ranges: dict from numeric facet to its list of `{'from': x, 'to': y}` buckets.
+        :param interval: interval of the buckets of date facets.
+        :param include_hits: False to only return the facets.
+        :param fields: list of fields to return, all by default.
+        :param exclude: list of fields to leave out of the returned objects.
+        :return: tuple with the list of objects that match the query, the total
+            number of hits and a dict from facet to its list of `{'key', 'count'}`.
+        """
+        assert search_model.page >= 1, 'page value %s is invalid' % search_model.page
+        sort, text = self._query_sort_and_text(search_model)
+        body = with_source_filter(
+            search_body(search_model.query, sort, search_model.page, search_model.offset,
+                        **self._parser_options(search_model.query)),
+            fields, exclude)
+        body['aggs'] = facet_aggregations(facets, size, ranges, interval)
+        if not include_hits:
+            body['size'] = 0
+            body.pop('from')
+            body.pop('sort')
+        self.logger.debug('elasticsearch::facets::%s', body)
         page = self.driver.es.search(
             index=self.driver.db_index,
             body=body,
             q=text or None
         )
+        log_slow_query(self.driver.slow_query_threshold, body, page)
 
-        object_list = []
-        for x in page['hits']['hits']:
-            object_list.append(x['_source'])
-        return object_list, page['hits']['total']
+        object_list, total = page_result(page)
+        return object_list, total, facet_results(page.get('aggregations', {}))
+
+    def _query_sort_and_text(self, search_model):
+        text = query_text(search_model.query)
+        return query_sort(self._sort_object(search_model.sort), text), text
 
-    def text_query(self, search_model: FullTextModel):
+    def text_query(self, search_model: FullTextModel, fields=None, exclude=None, track_total_hits=None):
         """Query elasticsearch for objects.
         :param search_model: object of FullTextModel
-        :return: list of objects that match the query.
+        :param fields: list of fields to return, all by default.
+        :param exclude: list of fields to leave out of the returned objects.
+        :param track_total_hits: True to count the total hits exactly or False to
+            skip counting them. An int counts them up to that number, which needs
+            Elasticsearch 7.0 or later. Elasticsearch's default when None.
+        :return: tuple with the list of objects that match the query and the
+            total number of hits, None when they are not tracked.
         """
         assert search_model.page >= 1, 'page value %s is invalid' % search_model.page
-        self.logger.debug('elasticsearch::text_query::{}'.format(search_model.text))
-        if search_model.sort is not None:
-            self._mapping_to_sort(search_model.sort.keys())
-            sort = self._sort_object(search_model.sort)
+        self.logger.debug('elasticsearch::text_query::%s', search_model.text)
+        body = text_query_body(search_model, self._text_query_sort(search_model), fields, exclude)
+        self._with_track_total_hits(body, track_total_hits)
+        return self._search_page(body, search_model.text)
+
+    def iter_query(self, search_model: [QueryModel, FullTextModel], batch_size=500, fields=None,
+                   exclude=None):
+        """Iterate over all the objects matching a query, regardless of its page
+        and offset.
+
+        Hits are fetched lazily in batches with `search_after`, using the query
+        sort with `_id` as tie breaker, so memory use is constant and results
+        are not bounded by `index.max_result_window`.
+
+        :param search_model: object of QueryModel or FullTextModel.
+        :param batch_size: number of objects fetched per request.
+        :param fields: list of fields to return, all by default.
+        :param exclude: list of fields to leave out of the returned objects.
+        :return: generator with all matching documents.
+        """
+        if isinstance(search_model, FullTextModel):
+            sort = self._text_query_sort(search_model)
+            q = search_model.text
+            body = {}
         else:
-            sort = [{"service.attributes.curation.rating": "asc"}]
-        body = {
-            'sort': sort,
-            'from': (search_model.page - 1) * search_model.offset,
-            'size': search_model.offset,
-        }
-
-        page = self.driver.es.search(
-            index=self.driver.db_index,
-            body=body,
-            q=search_model.text
+            sort, q = self._query_sort_and_text(search_model)
+            body = query_body(search_model.query, **self._parser_options(search_model.query))
+        if not any('_id' in clause for clause in sort):
+            sort = sort + [{"_id": "asc"}]
+        body = with_source_filter(dict(body, sort=sort), fields, exclude)
+        self.logger.debug('elasticsearch::iter_query::%s', body)
+
+        search_after = None
+        while True:
+            hits = self._search_after(body, batch_size, search_after, q=q or None)
+            for x in hits:
+                yield x['_source']
+            if len(hits) < batch_size:
+                return
+            search_after = hits[-1]['sort']
+
+    def export_ndjson(self, search_model: [QueryModel, FullTextModel], fp, batch_size=500, fields=None,
+                      exclude=None):
+        """Write all the objects matching a query to a file object, one JSON
+        document per line, streaming them with :meth:`iter_query`.
+        :param search_model: object of QueryModel or FullTextModel.
+        :param fp: text file object to write to.
+        :param batch_size: number of objects fetched per request.
+        :param fields: list of fields to export, all by default.
+        :param exclude: list of fields to leave out of the exported objects.
+        :return: number of objects written.
+        """
+        count = 0
+        for obj in self.iter_query(search_model, batch_size, fields, exclude):
+            fp.write(json.dumps(obj))
+            fp.write('\n')
+            count += 1
+        return count
+
+    def reindex(self, method='server', slices='auto', requests_per_second=None, chunk_size=500,
+                transform=None, progress=None, delete_old=False):
+        """Copy all the objects into a new version of the index created with the
+        current mapping and atomically swap the `db.index` alias to it, so the
+        mapping can change without downtime. Writes should be paused meanwhile.
+        :param method: `server` to copy with the `_reindex` API, `bulk` to
+            read the objects and write them again from the client.
+        :param slices: number of slices of a `server` reindex, `auto` by default.
+        :param requests_per_second: throttle of a `server` reindex.
+        :param chunk_size: objects read and written per request by a `bulk` reindex.
+        :param transform: function applied to every object by a `bulk` reindex.
+        :param progress: function called with a dict with the `total` number of
+            objects and the number of them `created` so far.
+        :param delete_old: delete the previous index once the alias is swapped.
+        :return: name of the new index.
+        """
+        self.logger.debug('elasticsearch::reindex::%s', method)
+        return self.driver.reindex(
+            method=method,
+            slices=slices,
+            requests_per_second=requests_per_second,
+            chunk_size=chunk_size,
+            transform=transform,
+            progress=progress,
+            delete_old=delete_old
         )
 
-        object_list = []
-        for x in page['hits']['hits']:
-            object_list.append(x['_source'])
-        return object_list, page['hits']['total']
+    def parallel_scan(self, n_slices, fn, executor=None, batch_size=500, scroll='5m', fields=None,
+                      exclude=None):
+        """Apply `fn` to every object in elasticsearch, splitting the index in
+        `n_slices` disjoint sliced scrolls processed in parallel.
+
+        Each slice is scanned by one task of `executor`, which fetches the next
+        batch only once `fn` went through the previous one, so a slow callback
+        slows down its scroll instead of buffering objects. Errors raised by
+        `fn` are collected and do not stop the scan.
+
+        :param n_slices: number of slices the index is split in.
+        :param fn: callable receiving the id and the value of each object. It
+            must be picklable when `executor` runs tasks in other processes.
+        :param executor: `concurrent.futures` executor running the slices, a
+            thread pool with one thread per slice by default.
+        :param batch_size: number of objects fetched per scroll request.
+        :param scroll: how long elasticsearch keeps each scroll context alive
+            between two requests.
+        :param fields: list of fields passed to `fn`, all by default.
+        :param exclude: list of fields left out of the objects passed to `fn`.
+        :return: dict with the number of `processed` objects, the `errors` of
+            `fn` as a list of (resource_id, error) and the `failed_slices` as a
+            dict from slice id to error.
+        """
+        self.logger.debug('elasticsearch::parallel_scan::%s', n_slices)
+        body = with_source_filter({'query': {'match_all': {}}}, fields, exclude)
+        own_executor = executor is None
+        if own_executor:
+            executor = ThreadPoolExecutor(max_workers=n_slices)
+        try:
+            futures = [
+                executor.submit(_scan_slice, self._config, slice_id, n_slices, fn, body, batch_size, scroll)
+                for slice_id in range(n_slices)
+            ]
+            result = {'processed': 0, 'errors': [], 'failed_slices': {}}
+            for slice_id, future in enumerate(futures):
+                try:
+                    processed, errors = future.result()
+                except Exception as e:
+                    result['failed_slices'][slice_id] = repr(e)
+                    continue
+                result['processed'] += processed
+                result['errors'].extend(errors)
+            return result
+        finally:
+            if own_executor:
+                executor.shutdown()
+
+    def _text_query_sort(self, search_model):
+        return text_query_sort(self._sort_object(search_model.sort))
+
+    def _search_page(self, body, q=None, template=False):
+        query_cache = self.driver.query_cache
+        if query_cache.enabled:
+            key = query_cache.key(body, q)
+            cached = query_cache.get(key)
+            if cached is not None:
+                return tuple(cached)
+            # A write finishing while the search runs makes its result stale.
+            generation = query_cache.generation
+
+        if template:
+            page = self.driver.es.search_template(
+                index=self.driver.db_index,
+                body=body
+            )
+        else:
+            page = self.driver.es.search(
+                index=self.driver.db_index,
+                body=body,
+                q=q
+            )
+        log_slow_query(self.driver.slow_query_threshold, body, page)
+
+        result = page_result(page)
+        if query_cache.enabled:
+            query_cache.put(key, result, generation)
+        return result
+
+    def _with_track_total_hits(self, body, track_total_hits):
+        cluster_version = self.driver.cluster_version if is_hits_threshold(track_total_hits) else None
+        return with_track_total_hits(body, track_total_hits, cluster_version)
+
+    def _search_template(self, shape, params, source_filter=False):
+        body = {'id': self._stored_template(shape, source_filter), 'params': params}
+        self.logger.debug('elasticsearch::query::template::%s', body)
+        return self._search_page(body, template=True)
+
+    def _stored_template(self, shape, source_filter=False):
+        """Id of the search template for `shape`, stored in the cluster the
+        first time this plugin uses it."""
+        _id = template_id(shape, source_filter)
+        if _id not in self._stored_templates:
+            self.driver.es.put_script(
+                id=_id,
+                body={'script': {'lang': 'mustache', 'source': template_source(shape, source_filter)}}
+            )
+            self._stored_templates.add(_id)
+        return _id
+
+    def _field_types(self, reload=False):
+        mapping_cache = self.driver.mapping_cache
+        if reload or mapping_cache.stale:
+            mapping_cache.load(self.driver.es.indices.get_mapping(index=self.driver.db_index))
+        return mapping_cache
+
+    def _parser_options(self, query):
+        """Options of `query_parser` for the field paths of `query`."""
+        keys = unknown_query_keys(query)
+        if not keys:
+            return {}
+        field_types = self._field_types()
+        if rejects_unmapped(keys, field_types, self.driver.unknown_fields):
+            # The fields may have been mapped dynamically since the mapping was loaded.
+            field_types = self._field_types(reload=True)
+        return {
+            'field_types': field_types,
+            'unknown_fields': self.driver.unknown_fields,
+        }
 
     def _mapping_to_sort(self, keys):
-        for i in keys:
-            mapping = """{
-                              "properties": {
-                                "%s" : { 
-                                  "type": "text",
-                                  "fields": {
-                                    "keyword": { 
-                                      "type": "keyword"
-                                    }
-                                  }
-                                }
-                              }
-                        }
-            """ % i
-            if self.driver.es.indices.get_field_mapping(i)[self.driver.db_index]['mappings'] == {}:
-                self.driver.es.indices.put_mapping(index=self.driver.db_index, body=mapping, doc_type='_doc')
+        if not unmapped_sort_keys(keys, self._field_types()):
+            return
+        # The fields may have been mapped dynamically since the mapping was loaded.
+        field_types = self._field_types(reload=True)
+        for key in unmapped_sort_keys(keys, field_types, self.driver.unknown_fields):
+            self.driver.es.indices.put_mapping(
+                index=self.driver.db_index, body=sort_mapping(key), doc_type='_doc')
+            field_types.invalidate()
 
     def _sort_object(self, sort):
+        """Sort clauses of the `sort` of a search model, None if it has none."""
+        if sort is None:
+            return None
+        self._mapping_to_sort(sort.keys())
+        return sort_object(sort, self._field_types())
+
+
+def _scan_slice(config, slice_id, n_slices, fn, body, batch_size, scroll):
+    """Scan one slice of the index for :meth:`Plugin.parallel_scan`. It is a
+    module function so it can be sent to process pools."""
+    driver = get_database_instance(config)
+    if n_slices > 1:
+        body = dict(body, slice={'id': slice_id, 'max': n_slices})
+    processed = 0
+    errors = []
+    for hit in scan(driver.es, query=body, index=driver.db_index, size=batch_size, scroll=scroll):
         try:
-            o = []
-            for key in sort.keys():
-                last_k = key.split('.')[-1]
-                field_mapping = self.driver.es.indices.get_field_mapping(key)
-                value = field_mapping[self.driver.db_index]['mappings']['_doc'][key]['mapping'][last_k]['type']
-                if value == 'text':
-                    o.append({key + ".keyword": ('asc' if sort.get(key) == 1 else 'desc')}, )
-                else:
-                    o.append({key: ('asc' if sort.get(key) == 1 else 'desc')}, )
-            return o
-        except Exception:
-            raise Exception("Sort \"{}\" does not have a valid format.".format(sort))
+            fn(hit['_id'], hit['_source'])
+        except Exception as e:
+            errors.append((hit['_id'], repr(e)))
+        processed += 1
+    return processed, errors
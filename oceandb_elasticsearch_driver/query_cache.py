@@ -0,0 +1,100 @@
+#  Copyright 2018 Ocean Protocol Foundation
+#  SPDX-License-Identifier: Apache-2.0
+
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class QueryCache(object):
+    """LRU cache of query results with a time to live.
+
+    Results are stored serialized, which bounds the cache by its size in bytes
+    and hands every caller its own copy. The cache is disabled when
+    `max_entries` is 0.
+
+    Every :meth:`clear` starts a new generation. A search reads the
+    :attr:`generation` before it is sent and passes it to :meth:`put`, which
+    drops its result if a write cleared the cache meanwhile.
+    """
+
+    def __init__(self, max_entries=0, ttl=60, max_bytes=64 * 1024 * 1024):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self._max_entries > 0
+
+    @property
+    def generation(self):
+        return self._generation
+
+    @staticmethod
+    def key(*parts):
+        """Normalized key for a search made of `parts` (body, query string...)."""
+        return json.dumps(parts, sort_keys=True, default=str)
+
+    def get(self, key):
+        """Cached value for `key`, None if it is missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[1] > self._ttl:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+        return json.loads(entry[0])
+
+    def put(self, key, value, generation=None):
+        """Cache `value` for `key`, unless the cache was cleared since
+        `generation` was read."""
+        data = json.dumps(value, default=str)
+        if len(data) > self._max_bytes:
+            return
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (data, time.monotonic())
+            self._bytes += len(data)
+            while len(self._entries) > self._max_entries or self._bytes > self._max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._bytes = 0
+
+    def after_fork(self):
+        """Reset the cache in a forked process, where the lock may be held by
+        a thread that only exists in the parent."""
+        self._lock = threading.Lock()
+        self.clear()
+
+    def stats(self):
+        """dict with the hits, misses, entries and bytes of the cache."""
+        with self._lock:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+            }
+
+    def _remove(self, key):
+        data, _ = self._entries.pop(key)
+        self._bytes -= len(data)
@@ -0,0 +1,171 @@
+#  Copyright 2018 Ocean Protocol Foundation
+#  SPDX-License-Identifier: Apache-2.0
+
+"""Versioned indices behind an alias.
+
+The data of `db.index` lives in a concrete index `<db.index>_v<N>` and is
+addressed through an alias named `db.index`. A mapping change is rolled out by
+copying the documents into `<db.index>_v<N+1>`, created with the current
+mapping, and swapping the alias to it in a single atomic request, so searches
+keep being served while the copy runs.
+"""
+
+import logging
+import re
+import time
+
+from elasticsearch.exceptions import RequestError
+from elasticsearch.helpers import scan, streaming_bulk
+
+logger = logging.getLogger(__name__)
+
+SERVER = 'server'
+BULK = 'bulk'
+
+# Settings of the live index kept by a new version unless the body sets them.
+_KEPT_SETTINGS = ('index.number_of_replicas', 'index.refresh_interval')
+
+
+def versioned_index(alias, version):
+    """Name of the concrete index holding `version` of the data of `alias`."""
+    return f'{alias}_v{version}'
+
+
+def bootstrap_index(es, alias, body):
+    """Create the first version of `alias` and point the alias to it, unless
+    an index or an alias named `alias` already exists.
+    """
+    if es.indices.exists(index=alias):
+        return
+    try:
+        es.indices.create(index=versioned_index(alias, 1), body=dict(body, aliases={alias: {}}))
+    except RequestError as e:
+        if not already_exists(e):
+            raise
+
+
+def already_exists(error):
+    """Whether a create index `error` is due to the index being created
+    meanwhile, by another process."""
+    return error.error == 'resource_already_exists_exception'
+
+
+def alias_indices(es, alias):
+    """Concrete indices behind `alias`, `[alias]` if it is an index created
+    before the versioned layout.
+    """
+    if es.indices.exists_alias(name=alias):
+        return sorted(es.indices.get_alias(name=alias))
+    return [alias]
+
+
+def next_version(es, alias):
+    pattern = re.compile(re.escape(alias) + r'_v(\d+)$')
+    versions = [int(m.group(1)) for m in map(pattern.match, es.indices.get(index=f'{alias}_v*'))
+                if m is not None]
+    return max(versions, default=0) + 1
+
+
+def reindex(es, alias, body, method=SERVER, slices='auto', requests_per_second=None,
+            chunk_size=500, transform=None, progress=None, poll_interval=1, delete_old=False):
+    """Copy the documents of `alias` into a new version of the index created
+    with `body`, then point the alias to it.
+
+    Documents written while the copy runs are not carried over, writers should
+    be paused until the alias is swapped.
+
+    :param es: `Elasticsearch` client.
+    :param alias: alias addressed by the plugin, `db.index`.
+    :param body: settings and mappings of the new index.
+    :param method: `server` to copy with the `_reindex` API, `bulk` to read
+        the documents and ingest them again from the client.
+    :param slices: number of slices of a `server` reindex, `auto` by default.
+    :param requests_per_second: throttle of a `server` reindex, unthrottled
+        by default.
+    :param chunk_size: number of documents read and written per request by a
+        `bulk` reindex.
+    :param transform: function applied to the `_source` of every document by
+        a `bulk` reindex.
+    :param progress: function called with a dict with the `total` number of
+        documents and the number of them `created` so far.
+    :param poll_interval: seconds between checks of a `server` reindex task.
+    :param delete_old: delete the previous versioned indices once the alias
+        is swapped.
+    :return: name of the new index.
+    """
+    if method not in (SERVER, BULK):
+        raise ValueError(f"Invalid reindex method {method}, use one of {[SERVER, BULK]}")
+    sources = alias_indices(es, alias)
+    index = versioned_index(alias, next_version(es, alias))
+    logger.info('elasticsearch::reindex::%s -> %s', sources, index)
+    # Replicas and refreshes are restored once all the documents are copied,
+    # to the values of the body or else to the ones of the live index.
+    settings = dict(body.get('settings', {}))
+    live = next(iter(es.indices.get_settings(
+        index=sources[0], name=list(_KEPT_SETTINGS), flat_settings=True).values()))['settings']
+    es.indices.create(index=index, body=dict(
+        body, settings=dict(settings, number_of_replicas=0, refresh_interval=-1)))
+    if method == SERVER:
+        _server_reindex(es, sources, index, slices, requests_per_second, progress, poll_interval)
+    else:
+        _bulk_reindex(es, sources, index, chunk_size, transform, progress)
+    es.indices.put_settings(index=index, body={
+        name: settings.get(name.split('.', 1)[1], live.get(name)) for name in _KEPT_SETTINGS
+    })
+    es.indices.refresh(index=index)
+
+    actions = [{'add': {'index': index, 'alias': alias}}]
+    for source in sources:
+        if source == alias:
+            # A concrete index with the name of the alias has to go in the same request.
+            actions.append({'remove_index': {'index': source}})
+        else:
+            actions.append({'remove': {'index': source, 'alias': alias}})
+    es.indices.update_aliases(body={'actions': actions})
+    if delete_old:
+        for source in sources:
+            if source != alias:
+                es.indices.delete(index=source)
+    return index
+
+
+def _server_reindex(es, sources, index, slices, requests_per_second, progress, poll_interval):
+    params = {'slices': slices, 'wait_for_completion': 'false'}
+    if requests_per_second is not None:
+        params['requests_per_second'] = requests_per_second
+    task_id = es.reindex(
+        body={'source': {'index': sources}, 'dest': {'index': index}},
+        params=params
+    )['task']
+    while True:
+        task = es.tasks.get(task_id=task_id)
+        status = task['task']['status']
+        if progress is not None:
+            progress({'total': status['total'], 'created': status['created']})
+        if task.get('completed'):
+            break
+        time.sleep(poll_interval)
+    response = task.get('response', {})
+    if task.get('error') or response.get('failures'):
+        raise Exception(f"Reindex into {index} failed: {task.get('error') or response['failures']}")
+
+
+def _bulk_reindex(es, sources, index, chunk_size, transform, progress):
+    total = es.count(index=','.join(sources))['count']
+    actions = (
+        {
+            '_op_type': 'index',
+            '_index': index,
+            '_type': '_doc',
+            '_id': hit['_id'],
+            '_source': transform(hit['_source']) if transform is not None else hit['_source'],
+        }
+        for hit in scan(es, index=','.join(sources), size=chunk_size)
+    )
+    created = 0
+    for _ in streaming_bulk(es, actions, chunk_size=chunk_size):
+        created += 1
+        if progress is not None and created % chunk_size == 0:
+            progress({'total': total, 'created': created})
+    if progress is not None:
+        progress({'total': total, 'created': created})
@@ -0,0 +1,112 @@
+#  Copyright 2018 Ocean Protocol Foundation
+#  SPDX-License-Identifier: Apache-2.0
+
+"""Stored mustache search templates for the common shapes of QueryModel queries.
+
+The shape of a query is the sorted sequence of its keys together with the
+kind of clause each one compiles to. Queries with the same shape share a
+template, whatever the order of their keys, so once it is stored in the
+cluster a search only sends the template id and the values of the query as
+parameters.
+"""
+
+import hashlib
+import json
+from datetime import datetime
+from functools import lru_cache
+
+from oceandb_elasticsearch_driver.utils import (
+    create_number_query,
+    create_terms_query,
+    create_time_query,
+    key_to_index_and_maker,
+)
+
+TERMS = 'terms'
+RANGE = 'range'
+MATCH = 'match'
+TIME = 'time'
+
+
+def query_shape(query):
+    """Shape of a QueryModel query, None if it can not be templated.
+
+    Only the predefined keys of `key_to_index_and_maker` are templated, queries
+    with `text` or custom field paths are sent as regular searches.
+    """
+    shape = []
+    # Keys are sorted so that permutations of a query do not store new scripts.
+    for key, value in sorted(query.items()):
+        if key == 'text' or key not in key_to_index_and_maker:
+            return None
+        query_maker = key_to_index_and_maker[key][1]
+        if query_maker == create_terms_query:
+            if value:
+                shape.append((key, TERMS))
+        elif query_maker == create_time_query:
+            shape.append((key, TIME))
+        elif query_maker == create_number_query:
+            if len(value) == 1:
+                shape.append((key, MATCH))
+            elif len(value) == 2:
+                shape.append((key, RANGE))
+        else:
+            return None
+    return tuple(shape)
+
+
+def template_id(shape, source_filter=False):
+    """Id of the stored script of the template for `shape`."""
+    digest = hashlib.sha1(repr((shape, source_filter)).encode('utf-8')).hexdigest()
+    return 'oceandb-query-' + digest[:16]
+
+
+@lru_cache(maxsize=256)
+def template_source(shape, source_filter=False):
+    """Mustache source of the search template for `shape`."""
+    clauses = []
+    for i, (key, kind) in enumerate(shape):
+        index = key_to_index_and_maker[key][0]
+        if kind == TERMS:
+            clauses.append('{"terms": {%s: %s}}' % (json.dumps(index + '.keyword'), _param(f'p{i}')))
+        elif kind == MATCH:
+            clauses.append('{"match": {%s: %s}}' % (json.dumps(index), _param(f'p{i}')))
+        else:
+            clauses.append('{"range": {%s: {"gte": %s, "lte": %s}}}' % (
+                json.dumps(index), _param(f'p{i}_gte'), _param(f'p{i}_lte')))
+    if clauses:
+        query = '{"bool": {"filter": [%s]}}' % ', '.join(clauses)
+    else:
+        query = '{"match_all": {}}'
+    source = '"sort": %s, "from": {{from}}, "size": {{size}}, "query": %s' % (_param('sort'), query)
+    if source_filter:
+        source += ', "_source": %s' % _param('_source')
+    return '{' + source + '}'
+
+
+def template_params(query, shape, sort, page, offset, _source=None):
+    """Parameters filling the template of `shape` for the values of `query`."""
+    params = {
+        'sort': sort,
+        'from': (page - 1) * offset,
+        'size': offset,
+    }
+    if _source is not None:
+        params['_source'] = _source
+    for i, (key, kind) in enumerate(shape):
+        value = query[key]
+        if kind == TERMS:
+            params[f'p{i}'] = list(value)
+        elif kind == MATCH:
+            params[f'p{i}'] = value[0]
+        elif kind == TIME:
+            params[f'p{i}_gte'] = datetime.strptime(value[0], '%Y-%m-%dT%H:%M:%SZ').isoformat()
+            params[f'p{i}_lte'] = datetime.strptime(value[1], '%Y-%m-%dT%H:%M:%SZ').isoformat()
+        else:
+            params[f'p{i}_gte'] = value[0]
+            params[f'p{i}_lte'] = value[1]
+    return params
+
+
+def _param(name):
+    return '{{#toJson}}%s{{/toJson}}' % name
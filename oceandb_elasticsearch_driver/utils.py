@@ -7,79 +7,314 @@ from datetime import datetime
 import oceandb_elasticsearch_driver.indexes as indexes
 
 logger = logging.getLogger(__name__)
+slow_query_logger = logging.getLogger('oceandb_elasticsearch_driver.slow_query')
 
 MUST = "must"
 SHOULD = "should"
+FILTER = "filter"
 RANGE = "range"
 BOOL = "bool"
 FUZZY = "fuzzy"
 MATCH = "match"
+TERMS = "terms"
 GTE = "gte"
 LTE = "lte"
 
+# Policies of `db.unknown_fields` for query keys that are not predefined in
+# `key_to_index_and_maker` nor mapped in the index.
+ALLOW = 'allow'
+REJECT = 'reject'
+UNKNOWN_FIELDS_POLICIES = (ALLOW, REJECT)
 
-def query_parser(query):
+# Mapped types queried as numbers, with a match for one value or a range for two.
+RANGE_TYPES = ('long', 'integer', 'short', 'byte', 'double', 'float', 'half_float', 'scaled_float', 'date')
+
+
+def log_slow_query(threshold, body, result):
+    """Log the body of a search that took at least `threshold` milliseconds in
+    Elasticsearch, according to the `took` of its `result`."""
+    took = result.get('took')
+    if threshold and took is not None and took >= threshold:
+        slow_query_logger.warning(
+            'elasticsearch::slow_query::%sms::%s', took, body, extra={'took': took, 'body': body})
+
+
+def patch_body(partial=None, upsert=False, script=None):
+    """Body of an update request merging `partial` into a document, or running
+    `script` on it."""
+    if script is not None:
+        body = {'script': dict(script, lang=script.get('lang', 'painless'))}
+        if upsert:
+            body['upsert'] = partial or {}
+        return body
+    body = {'doc': partial or {}}
+    if upsert:
+        body['doc_as_upsert'] = True
+    return body
+
+
+def search_body(query, sort, page, offset, **parser_options):
+    """Build the body of a paginated search over the parsed `query`, the
+    keyword arguments are the options of :func:`query_parser`."""
+    return dict(query_body(query, **parser_options), **{
+        'sort': sort,
+        'from': (page - 1) * offset,
+        'size': offset,
+    })
+
+
+def query_body(query, **parser_options):
+    """Body of a search or count request over the parsed `query`, matching
+    every document when it is empty."""
+    return {'query': query_parser(query, **parser_options) if query else {'match_all': {}}}
+
+
+def list_body(fields=None, exclude=None):
+    """Body of a search over all the documents in `_id` order."""
+    return with_source_filter({
+        'sort': [
+            {"_id": "asc"},
+        ],
+        'query': {
+            'match_all': {}
+        }
+    }, fields, exclude)
+
+
+def list_range(search_from=None, search_to=None, limit=None):
+    """Offset of the first document listed and max number of documents, None
+    for all, for the `search_from`, `search_to` and `limit` of a list."""
+    search_from = search_from if search_from is not None and search_from >= 0 else 0
+    if search_to is not None and search_to >= 0:
+        to_limit = search_to - search_from + 1
+        limit = to_limit if limit is None else min(limit, to_limit)
+    return search_from, limit
+
+
+def text_query_body(search_model, sort, fields=None, exclude=None):
+    """Body of the search of a FullTextModel, whose text is sent as `q`."""
+    return with_source_filter({
+        'sort': sort,
+        'from': (search_model.page - 1) * search_model.offset,
+        'size': search_model.offset,
+    }, fields, exclude)
+
+
+def with_track_total_hits(body, track_total_hits, cluster_version=None):
+    """Add `track_total_hits` to a search body, unless it is None. A number
+    of hits needs the major `cluster_version` to be 7 or later."""
+    if track_total_hits is None:
+        return body
+    if not isinstance(track_total_hits, bool):
+        if not is_hits_threshold(track_total_hits) or cluster_version is None or cluster_version < 7:
+            raise ValueError(
+                f"Invalid track_total_hits {track_total_hits}, use True or False, a number of "
+                f"hits needs Elasticsearch 7.0 or later")
+    body['track_total_hits'] = track_total_hits
+    return body
+
+
+def is_hits_threshold(track_total_hits):
+    """Whether `track_total_hits` counts the hits up to a number."""
+    return isinstance(track_total_hits, int) and not isinstance(track_total_hits, bool)
+
+
+def page_result(page):
+    """Objects of a search response and its total number of hits, None when
+    they are not tracked."""
+    total = page['hits'].get('total')
+    if total == -1:
+        # Elasticsearch 6.x reports -1 when the total hits are not tracked.
+        total = None
+    return [x['_source'] for x in page['hits']['hits']], total
+
+
+def mget_body(resource_ids, fields=None, exclude=None):
+    """Body of a multi-get request for `resource_ids`."""
+    _source = source_filter(fields, exclude)
+    if _source is None:
+        return {'ids': resource_ids}
+    return {'docs': [{'_id': resource_id, '_source': _source} for resource_id in resource_ids]}
+
+
+def source_filter(fields=None, exclude=None):
+    """`_source` filter returning only `fields` and dropping `exclude`, or
+    None when the whole document is requested."""
+    if not fields and not exclude:
+        return None
+    _source = {}
+    if fields:
+        _source['includes'] = list(fields)
+    if exclude:
+        _source['excludes'] = list(exclude)
+    return _source
+
+
+def with_source_filter(body, fields=None, exclude=None):
+    """Add the `_source` filter for `fields` and `exclude` to a search body."""
+    _source = source_filter(fields, exclude)
+    if _source is not None:
+        body['_source'] = _source
+    return body
+
+
+def text_terms(text):
+    """Normalize the `text` value of a query into the list of terms searched."""
+    if isinstance(text, str):
+        text = [text]
+    text = [t.strip() for t in text]
+    return [t.replace('did:op:', '0x') for t in text if t]
+
+
+def query_text(query):
+    """Remove the `text` key from a QueryModel `query` and return its terms,
+    None if there are none. They are searched with `q`, which replaces the
+    query of the body of a search."""
+    if 'text' not in query:
+        return None
+    return text_terms(query.pop('text')) or None
+
+
+def sort_clause(key, field_type, order):
+    """Sort clause for `key`, text fields are sorted by their keyword subfield."""
+    direction = 'asc' if order == 1 else 'desc'
+    if field_type == 'text':
+        return {key + ".keyword": direction}
+    return {key: direction}
+
+
+def sort_object(sort, field_types):
+    """Sort clauses of the `sort` of a search model, typed with `field_types`."""
+    o = []
+    for key in sort.keys():
+        value = field_types.field_type(key)
+        if value is None:
+            raise Exception("Sort \"{}\" does not have a valid format.".format(sort))
+        o.append(sort_clause(key, value, sort.get(key)))
+    return o
+
+
+def query_sort(sort=None, text=None):
+    """Sort of a QueryModel search, `sort` or else `_id` order, after the
+    score when the query has `text`."""
+    sort = sort if sort is not None else [{"_id": "asc"}]
+    if text:
+        sort = [{"_score": "desc"}] + sort
+    return sort
+
+
+def text_query_sort(sort=None):
+    """Sort of a FullTextModel search, `sort` or else the curation rating."""
+    return sort if sort is not None else [{"service.attributes.curation.rating": "asc"}]
+
+
+def unmapped_sort_keys(keys, field_types, unknown_fields=ALLOW):
+    """Sort `keys` that are not mapped in `field_types`. They are about to be
+    mapped, which only the `allow` policy of `unknown_fields` permits."""
+    missing = [key for key in keys if key not in field_types]
+    if missing and unknown_fields != ALLOW:
+        raise ValueError(f"Sort field {missing[0]} is not mapped in the index")
+    return missing
+
+
+def sort_mapping(key):
+    """Mapping added for a sort key that is not mapped in the index yet."""
+    return """{
+                  "properties": {
+                    "%s" : {
+                      "type": "text",
+                      "fields": {
+                        "keyword": {
+                          "type": "keyword"
+                        }
+                      }
+                    }
+                  }
+            }
+    """ % key
+
+
+def query_parser(query, field_types=None, unknown_fields=ALLOW):
+    """Compile a QueryModel query into an Elasticsearch bool query.
+
+    Only the `text` key is scored, under `bool.must`. Every other constraint
+    goes under `bool.filter`, where it is not scored and can be cached by the
+    node query cache; exact-value keys are compiled into `terms` queries on
+    their `.keyword` subfield.
+
+    Keys that are not predefined are field paths, queried according to their
+    type in `field_types` (a `MappingCache`). Paths that are not mapped are
+    handled according to `unknown_fields`: `allow` guesses the query from the
+    values and `reject` raises ValueError.
+    """
     query_must = []
-    key_to_index_and_maker = {
-        'text': (None, create_text_query),
-        'license': (indexes.license, create_query),
-        'categories': (indexes.categories, create_query),
-        'tags': (indexes.tags, create_query),
-        'metadata_type': (indexes.metadata_type, create_query),
-        'service_type': (indexes.service_type, create_query),
-        'type': (indexes.service_type, create_query),
-        'updateFrequency': (indexes.updated_frequency, create_query),
-        'sample': (indexes.sample, create_query),
-        'created': (indexes.created, create_time_query),
-        'dataToken': (indexes.dataToken, create_query),
-        'dateCreated': (indexes.dateCreated, create_time_query),
-        'datePublished': (indexes.datePublished, create_time_query),
-        'cost': (indexes.cost, create_number_query)
-    }
+    query_filter = []
     for key, value in query.items():
-        if key not in key_to_index_and_maker:
-            index = key
-            if isinstance(value[0], int) or isinstance(value[0], float):
-                query_maker = create_number_query
-            else:
-                query_maker = create_query
-        else:
+        if key in key_to_index_and_maker:
             index, query_maker = key_to_index_and_maker[key]
+        else:
+            index, query_maker = unknown_key_query(key, value, field_types, unknown_fields)
 
         if index is not None:
-            query_must = query_maker(query_must, index, value)
+            query_filter = query_maker(query_filter, index, value)
         else:
             query_must = query_maker(query_must, value)
 
     query_result = {
         BOOL: {
-            MUST: query_must
+            FILTER: query_filter
         }
     }
+    if query_must:
+        query_result[BOOL][MUST] = query_must
     return query_result
 
 
-def create_time_query(query_must, index, value):
+def unknown_key_query(key, value, field_types=None, unknown_fields=ALLOW):
+    """Field and query maker for the key of a query that is not predefined."""
+    field_type = field_types.field_type(key) if field_types is not None else None
+    if unknown_fields == REJECT and unmapped(key, field_types):
+        raise ValueError(f"Field {key} is not mapped in the index and can not be queried")
+    if field_type is None:
+        is_number = bool(value) and isinstance(value[0], (int, float))
+    else:
+        is_number = field_type in RANGE_TYPES
+    return key, create_number_query if is_number else create_query
+
+
+def unknown_query_keys(query):
+    """Keys of a QueryModel `query` that are field paths, not predefined fields."""
+    return [key for key in query if key not in key_to_index_and_maker]
+
+
+def rejects_unmapped(keys, field_types, unknown_fields=ALLOW):
+    """Whether the `unknown_fields` policy rejects some of the field path
+    `keys` as they are not mapped in `field_types`."""
+    return unknown_fields != ALLOW and any(unmapped(key, field_types) for key in keys)
+
+
+def unmapped(key, field_types=None):
+    """Whether the field path `key` is neither mapped in `field_types` nor a
+    predefined index."""
+    return key not in indexes.list_indexes and (field_types is None or key not in field_types)
+
+
+def create_time_query(query_filter, index, value):
     if value[0] is None or value[1] is None:
         logger.warning("You should provide two dates in your query.")
 
     if value[0] > value[1]:
         logger.warning("Your second date is smaller that the first.")
 
-    query_should = [{
+    query_filter.append({
         RANGE: {
             index: {
                 GTE: datetime.strptime(value[0], '%Y-%m-%dT%H:%M:%SZ'),
                 LTE: datetime.strptime(value[1], '%Y-%m-%dT%H:%M:%SZ')
             }
         }
-    }]
-    query_must.append({
-        BOOL: {
-            SHOULD: query_should
-        }
     })
-    return query_must
+    return query_filter
 
 
 def create_text_query(query_must, value):
@@ -97,28 +332,35 @@ def create_text_query(query_must, value):
     return query_must
 
 
-def create_query(query_must, index, value):
+def create_terms_query(query_filter, index, value):
+    """Exact match of any of the values on the keyword subfield of `index`,
+    an empty list of values does not constrain the query."""
+    if value:
+        query_filter.append({TERMS: {index + '.keyword': list(value)}})
+    return query_filter
+
+
+def create_query(query_filter, index, value):
     query_should = []
     for i in range(len(value)):
         query_should.append({MATCH: {index: value[i]}})
-    query_must.append({BOOL: {SHOULD: query_should}})
-    return query_must
+    query_filter.append({BOOL: {SHOULD: query_should}})
+    return query_filter
 
 
-def create_number_query(query_must, index, value):
-    query_should = []
+def create_number_query(query_filter, index, value):
     if len(value) > 2:
         logger.info('You are sending more values than needed.')
     elif len(value) == 0:
         logger.info('You are not sending any value.')
     elif len(value) == 1:
-        query_should.append({
+        query_filter.append({
             MATCH: {
                 index: value[0]
             }
         })
     else:
-        query_should.append({
+        query_filter.append({
             RANGE: {
                 index: {
                     GTE: value[0],
@@ -126,10 +368,66 @@ def create_number_query(query_must, index, value):
                 }
             }
         })
-    query_must.append({
-        BOOL: {
-            SHOULD: query_should
-        }
-    })
-    print(query_must)
-    return query_must
+    return query_filter
+
+
+key_to_index_and_maker = {
+    'text': (None, create_text_query),
+    'license': (indexes.license, create_terms_query),
+    'categories': (indexes.categories, create_terms_query),
+    'tags': (indexes.tags, create_terms_query),
+    'metadata_type': (indexes.metadata_type, create_terms_query),
+    'service_type': (indexes.service_type, create_terms_query),
+    'type': (indexes.service_type, create_terms_query),
+    'updateFrequency': (indexes.updated_frequency, create_terms_query),
+    'sample': (indexes.sample, create_terms_query),
+    'created': (indexes.created, create_time_query),
+    'dataToken': (indexes.dataToken, create_terms_query),
+    'dateCreated': (indexes.dateCreated, create_time_query),
+    'datePublished': (indexes.datePublished, create_time_query),
+    'cost': (indexes.cost, create_number_query)
+}
+
+
+def facet_aggregations(facets, size=10, ranges=None, interval='month'):
+    """Aggregations counting the documents per value of each facet.
+
+    :param facets: names of `key_to_index_and_maker` keys. Exact-value keys
+        get a terms aggregation, dates a date histogram and numbers a range
+        aggregation over the buckets given in `ranges`.
+    :param size: max number of terms buckets per facet.
+    :param ranges: dict from numeric facet name to its list of
+        `{'from': x, 'to': y}` buckets.
+    :param interval: interval of the date histograms.
+    """
+    ranges = ranges or {}
+    aggs = {}
+    for name in facets:
+        if name not in key_to_index_and_maker or key_to_index_and_maker[name][0] is None:
+            raise ValueError(f'Invalid facet {name}, use one of the predefined query fields.')
+        index, query_maker = key_to_index_and_maker[name]
+        if query_maker == create_time_query:
+            aggs[name] = {'date_histogram': {'field': index, 'interval': interval, 'min_doc_count': 1}}
+        elif query_maker == create_number_query:
+            if name not in ranges:
+                raise ValueError(f'Facet {name} needs a list of ranges.')
+            aggs[name] = {'range': {'field': index, 'ranges': ranges[name]}}
+        else:
+            aggs[name] = {'terms': {'field': index + '.keyword', 'size': size}}
+    return aggs
+
+
+def facet_results(aggregations):
+    """Buckets of the `facet_aggregations` of a search response, as a dict from
+    facet name to a list of `{'key': ..., 'count': ...}`."""
+    facets = {}
+    for name, aggregation in aggregations.items():
+        buckets = []
+        for bucket in aggregation['buckets']:
+            result = {'key': bucket.get('key_as_string', bucket['key']), 'count': bucket['doc_count']}
+            for bound in ('from', 'to'):
+                if bound in bucket:
+                    result[bound] = bucket[bound]
+            buckets.append(result)
+        facets[name] = buckets
+    return facets
@@ -14,7 +14,10 @@ with open('README.md') as readme_file:
 with open('CHANGELOG.md') as changelog_file:
     changelog = changelog_file.read()
 
-requirements = ['oceandb-driver-interface', 'elasticsearch', ]
+requirements = ['oceandb-driver-interface', 'elasticsearch>=6.0.0,<7.0.0', ]
+
+# The asyncio transport of the 6.x client, it does not support Python 3.11+.
+extras_requirements = {'async': ['elasticsearch-async>=6.2.0,<7.0.0; python_version < "3.11"'], }
 
 setup_requirements = ['pytest-runner', ]
 
@@ -34,6 +37,7 @@ setup(
     ],
     description="🐳 OceanDB ElasticSearch Driver (Python).",
     install_requires=requirements,
+    extras_require=extras_requirements,
     license="Apache Software License 2.0",
     long_description=readme,
     long_description_content_type="text/markdown",
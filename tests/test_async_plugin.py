@@ -0,0 +1,58 @@
+#  Copyright 2018 Ocean Protocol Foundation
+#  SPDX-License-Identifier: Apache-2.0
+import asyncio
+
+import pytest
+from oceandb_driver_interface.search_model import FullTextModel, QueryModel
+from oceandb_driver_interface.utils import parse_config
+
+from oceandb_elasticsearch_driver.instance import AsyncElasticsearch
+
+pytestmark = pytest.mark.skipif(AsyncElasticsearch is None, reason='AsyncElasticsearch is not available')
+
+
+def test_async_plugin_crud_and_queries():
+    from oceandb_elasticsearch_driver.async_plugin import AsyncPlugin
+
+    async def run():
+        es = AsyncPlugin(parse_config('./tests/oceandb.ini'))
+        assert es.type == 'Elasticsearch'
+        await es.write({"value": "asyncTest"}, 'async1')
+        with pytest.raises(ValueError):
+            await es.write({"value": "asyncTest"}, 'async1')
+        assert (await es.read('async1'))['value'] == 'asyncTest'
+        assert await es.read('async1', fields=['value']) == {"value": "asyncTest"}
+        await es.update({"value": "asyncUpdated"}, 'async1')
+        results, total = await es.query(QueryModel({'value': ['asyncUpdated']}))
+        assert results[0]['value'] == 'asyncUpdated'
+        assert total == 1
+        results, total = await es.query(QueryModel({'value': ['asyncUpdated']}), track_total_hits=False)
+        assert results[0]['value'] == 'asyncUpdated'
+        assert total is None
+        assert len((await es.text_query(FullTextModel('asyncUpdated')))[0]) == 1
+        assert await es.count() >= 1
+        assert await es.count(QueryModel({'value': ['asyncUpdated']})) == 1
+        assert await es.count(QueryModel({'value': ['missing']})) == 0
+        values = [doc.get('value') async for doc in es.list()]
+        assert 'asyncUpdated' in values
+        await es.delete('async1')
+        with pytest.raises(ValueError):
+            await es.delete('async1')
+        await es.close()
+
+    asyncio.run(run())
+
+
+def test_async_plugin_event_loops():
+    from oceandb_elasticsearch_driver.async_plugin import AsyncPlugin
+
+    # Created outside of any running loop, then used from two of them.
+    es = AsyncPlugin(parse_config('./tests/oceandb.ini'))
+
+    async def run():
+        assert await es.driver.is_ready()
+        assert await es.count() >= 0
+        await es.close()
+
+    asyncio.run(run())
+    asyncio.run(run())
@@ -1,13 +1,29 @@
 #  Copyright 2018 Ocean Protocol Foundation
 #  SPDX-License-Identifier: Apache-2.0
+import io
+import json
 import time
+
 import pytest
+from elasticsearch.exceptions import NotFoundError, RequestError
 from oceandb_driver_interface.oceandb import OceanDb
+from oceandb_driver_interface.utils import parse_config
 from oceandb_driver_interface.search_model import FullTextModel, QueryModel
 
-from oceandb_elasticsearch_driver.utils import query_parser
+from oceandb_elasticsearch_driver.instance import ElasticsearchInstance, get_database_instance, index_sort
+from oceandb_elasticsearch_driver.mapping import mapping, mapping_profile
+from oceandb_elasticsearch_driver.mapping_cache import MappingCache
+from oceandb_elasticsearch_driver.query_cache import QueryCache
+from oceandb_elasticsearch_driver.templates import query_shape, template_id, template_params, template_source
+from oceandb_elasticsearch_driver.utils import (
+    facet_aggregations,
+    facet_results,
+    log_slow_query,
+    query_parser,
+)
 from .ddo_example import ddo_sample
 
+config = parse_config('./tests/oceandb.ini')
 es = OceanDb('./tests/oceandb.ini').plugin
 
 
@@ -26,6 +42,53 @@ def test_plugin_type_is_es():
     assert es.type == 'Elasticsearch'
 
 
+def test_plugin_is_ready():
+    assert es.is_ready()
+    assert es.driver.health()['status'] in ('green', 'yellow')
+
+
+def test_readiness_probe_does_not_wait():
+    driver = ElasticsearchInstance({'db.port': '1', 'db.username': 'elastic', 'db.password': 'changeme',
+                                    'db.startup_timeout': '5'})
+    start = time.monotonic()
+    assert not driver.is_ready()
+    assert driver.health() is None
+    assert time.monotonic() - start < 1
+
+
+def test_database_instance_registry():
+    assert get_database_instance(config) is es.driver
+    assert get_database_instance(dict(config)) is es.driver
+    other = get_database_instance(dict(config, **{'db.refresh': 'true'}))
+    assert other is not es.driver
+    assert other.refresh_policy == 'true'
+    es.driver._pid = -1
+    pool = es.driver._es
+    assert es.driver.es is not pool
+    assert es.driver.es.ping()
+
+
+def test_index_settings(monkeypatch):
+    assert index_sort('created') == {'sort.field': ['created'], 'sort.order': ['desc']}
+    assert index_sort('created, service.attributes.main.datePublished', 'desc,asc') == {
+        'sort.field': ['created', 'service.attributes.main.datePublished'],
+        'sort.order': ['desc', 'asc'],
+    }
+    with pytest.raises(ValueError):
+        index_sort('created,updated', 'desc,asc,asc')
+    with pytest.raises(ValueError):
+        index_sort('created', 'newest')
+
+    monkeypatch.setenv('DB_NUMBER_OF_SHARDS', '2')
+    monkeypatch.setenv('DB_NUMBER_OF_REPLICAS', '0')
+    monkeypatch.setenv('DB_INDEX_SORT_FIELD', 'created')
+    settings = ElasticsearchInstance(config).index_body['settings']
+    assert settings['number_of_shards'] == 2
+    assert settings['number_of_replicas'] == 0
+    assert settings['index'] == {'sort.field': ['created'], 'sort.order': ['desc']}
+    assert 'ocean_normalizer' in settings['analysis']['normalizer']
+
+
 def test_write_without_id():
     object_id = es.write({"value": "test"})
     es.delete(object_id)
@@ -55,6 +118,25 @@ def test_plugin_write_and_read():
     es.delete(1)
 
 
+def test_read_many():
+    es.write({"value": "test1", "other": "x"}, 'many1')
+    es.write({"value": "test2", "other": "y"}, 'many2')
+    objects, missing = es.read_many(['many2', 'manyMissing', 'many1'])
+    assert [o and o['value'] for o in objects] == ['test2', None, 'test1']
+    assert missing == ['manyMissing']
+    objects, _ = es.read_many(['many1'], fields=['value'])
+    assert objects == [{"value": "test1"}]
+    objects, _ = es.read_many(['many1'], exclude=['value'])
+    assert objects == [{"other": "x"}]
+    assert es.read_many([]) == ([], [])
+    assert es.read('many1', fields=['value']) == {"value": "test1"}
+    assert es.read('many1', exclude=['value']) == {"other": "x"}
+    with pytest.raises(NotFoundError):
+        es.read('manyMissing', fields=['value'])
+    es.delete('many1')
+    es.delete('many2')
+
+
 def test_update():
     es.write({"value": "test"}, 1)
     assert es.read(1)['value'] == 'test'
@@ -63,6 +145,69 @@ def test_update():
     es.delete(1)
 
 
+def test_bulk_write_update_delete():
+    ids = [f'bulk{i}' for i in range(5)]
+    results = es.write_many((_id, {"value": "test"}) for _id in ids)
+    assert len(results) == 5
+    assert all(ok for ok, _ in results)
+    assert es.read('bulk0')['value'] == 'test'
+
+    results = es.write_many([('bulk0', {"value": "test"})])
+    assert not results[0][0]
+    assert results[0][1]['create']['status'] == 409
+
+    results = es.update_many((_id, {"value": "testUpdated"}) for _id in ids)
+    assert all(ok for ok, _ in results)
+    assert es.read('bulk4')['value'] == 'testUpdated'
+
+    results = es.delete_many(ids + ['bulkMissing'], chunk_size=2)
+    assert [ok for ok, _ in results] == [True] * 5 + [False]
+
+    results = es.iter_bulk({'_op_type': 'index', '_index': es.driver.db_index, '_type': '_doc',
+                            '_id': _id, '_source': {"value": "iter"}} for _id in ids)
+    assert es.read_many(ids)[1] == ids
+    assert all(ok for ok, _ in results)
+    assert es.read('bulk0')['value'] == 'iter'
+    es.delete_many(ids)
+
+
+def test_patch():
+    es.write({"value": "test", "views": 0}, 'patch1')
+    version = es.patch('patch1', {"value": "testPatched"})
+    assert version['result'] == 'updated'
+    assert es.read('patch1') == {"value": "testPatched", "views": 0}
+
+    es.patch('patch1', script={'source': 'ctx._source.views += params.n', 'params': {'n': 2}},
+             if_seq_no=version['_seq_no'], if_primary_term=version['_primary_term'])
+    assert es.read('patch1')['views'] == 2
+    with pytest.raises(ValueError):
+        es.patch('patch1', {"value": "stale"}, if_seq_no=version['_seq_no'],
+                 if_primary_term=version['_primary_term'])
+    with pytest.raises(ValueError):
+        es.patch('patchMissing', {"value": "test"})
+    with pytest.raises(ValueError):
+        es.patch('patch1', {"value": "test"}, if_seq_no=version['_seq_no'])
+    with pytest.raises(ValueError):
+        es.patch('patch1', {"value": "test"}, if_primary_term=version['_primary_term'])
+
+    assert es.patch('patch2', {"value": "upserted"}, upsert=True)['result'] == 'created'
+    results = es.patch_many([('patch1', {"views": 5}), ('patch3', {"views": 1})])
+    assert [ok for ok, _ in results] == [True, False]
+    assert es.read('patch1')['views'] == 5
+    es.delete('patch1')
+    es.delete('patch2')
+
+
+def test_deferred_refresh():
+    es.write({"value": "deferred"}, 'deferred1', refresh='deferred')
+    es.update({"value": "deferredUpdated"}, 'deferred1', refresh='deferred')
+    es.flush()
+    assert es.query(QueryModel({'value': ['deferredUpdated']}))[0][0]['value'] == 'deferredUpdated'
+    with pytest.raises(ValueError):
+        es.write({"value": "test"}, 'deferred2', refresh='sometimes')
+    es.delete('deferred1')
+
+
 def test_plugin_list():
     delete_all()
     count = 27
@@ -73,6 +218,7 @@ def test_plugin_list():
             print(f'resource already exist: {i} <error>: {e}')
 
     assert len(list(es.list())) == count
+    assert len(list(es.list(chunk_size=5))) == count
     assert list(es.list())[0]['value0'] == 'test0'
     es.delete(0)
     time.sleep(2)
@@ -83,10 +229,101 @@ def test_plugin_list():
     assert result[1]['value13'] == 'test13'
     result = list(es.list(search_from=1, limit=2))
     assert result[0]['value10'] == 'test10'
+    assert len(result) == 2
+    result = list(es.list(search_from=20, chunk_size=2))
+    assert len(result) == count - 1 - 20
     for i in range(1, count):
         es.delete(i)
 
 
+def test_iter_query_and_export():
+    delete_all()
+    es.write_many((f'iter{i}', {"value": "iter", "number": i}) for i in range(7))
+    results = list(es.iter_query(QueryModel({'value': ['iter']}, offset=2), batch_size=3))
+    assert sorted(r['number'] for r in results) == list(range(7))
+    results = list(es.iter_query(QueryModel({'value': ['iter']}, sort={'number': -1}), batch_size=2))
+    assert [r['number'] for r in results] == list(range(6, -1, -1))
+    results = list(es.iter_query(FullTextModel('iter'), batch_size=5, fields=['number']))
+    assert len(results) == 7 and set(results[0].keys()) == {'number'}
+
+    fp = io.StringIO()
+    assert es.export_ndjson(QueryModel({'value': ['iter']}), fp, batch_size=4) == 7
+    lines = fp.getvalue().splitlines()
+    assert len(lines) == 7
+    assert json.loads(lines[0])['value'] == 'iter'
+    es.delete_many(f'iter{i}' for i in range(7))
+
+
+def test_parallel_scan():
+    delete_all()
+    es.write_many((f'scan{i}', {"value": "scan", "number": i}) for i in range(20))
+    seen = []
+
+    def fn(resource_id, obj):
+        if obj['number'] == 13:
+            raise ValueError('unlucky')
+        seen.append(resource_id)
+
+    result = es.parallel_scan(3, fn, batch_size=4)
+    assert result['processed'] == 20
+    assert result['failed_slices'] == {}
+    assert result['errors'] == [('scan13', "ValueError('unlucky')")]
+    assert sorted(seen) == sorted(f'scan{i}' for i in range(20) if i != 13)
+    es.delete_many(f'scan{i}' for i in range(20))
+
+
+def test_bulk_load_mode():
+    delete_all()
+    indices = es.driver.es.indices
+
+    def settings():
+        return next(iter(indices.get_settings(index=es.driver.db_index, flat_settings=True).values()))[
+            'settings']
+
+    before = settings()
+    with pytest.raises(RuntimeError):
+        with es.bulk_load_mode():
+            assert settings()['index.refresh_interval'] == '-1'
+            assert settings()['index.translog.durability'] == 'async'
+            es.write_many((f'load{i}', {"value": "load"}) for i in range(10))
+            raise RuntimeError
+    after = settings()
+    for name in ('index.refresh_interval', 'index.number_of_replicas', 'index.translog.durability'):
+        assert after.get(name) == before.get(name)
+    assert es.count() == 10
+    es.delete_many(f'load{i}' for i in range(10))
+
+
+def test_reindex():
+    delete_all()
+    es.write_many((f'reindex{i}', {"value": "reindex"}) for i in range(10))
+    progress = []
+    old_indices = es.driver.es.indices.get_alias(name=es.driver.db_index)
+    es.driver.es.indices.put_settings(index=es.driver.db_index, body={'index.number_of_replicas': 0})
+    index = es.reindex(progress=progress.append, delete_old=True)
+    assert list(es.driver.es.indices.get_alias(name=es.driver.db_index)) == [index]
+    assert index not in old_indices
+    assert progress[-1] == {'total': 10, 'created': 10}
+    assert es.count() == 10
+    settings = es.driver.es.indices.get_settings(index=index, flat_settings=True)[index]['settings']
+    assert settings['index.number_of_replicas'] == '0'
+
+    index = es.reindex(method='bulk', transform=lambda obj: dict(obj, value='reindexed'),
+                       delete_old=True)
+    assert list(es.driver.es.indices.get_alias(name=es.driver.db_index)) == [index]
+    assert es.read('reindex0')['value'] == 'reindexed'
+    es.delete_many(f'reindex{i}' for i in range(10))
+
+
+def test_bootstrap_error_is_raised():
+    driver = ElasticsearchInstance(dict(config, **{'db.index': 'oceandb_driver_bad_sort',
+                                                   'db.index_sort_field': 'missingField'}))
+    with pytest.raises(RequestError):
+        driver.es
+    assert not driver.is_ready()
+    assert not driver._es.indices.exists(index='oceandb_driver_bad_sort')
+
+
 def test_search_query():
     delete_all()
     es.write(ddo_sample, ddo_sample['id'])
@@ -125,6 +362,27 @@ def test_search_query():
     search_model = QueryModel({'cost': ["0", "12"], 'text': ['Weather']})
     assert es.query(search_model)[0][0]['id'] == ddo_sample['id']
 
+    result = es.query(QueryModel({'license': ['CC-BY']}), fields=['id', 'service.attributes.main.name'])[0][0]
+    assert set(result.keys()) == {'id', 'service'}
+    assert 'publicKey' not in es.read(ddo_sample['id'], exclude=['publicKey', 'proof'])
+    assert list(es.list(fields=['id'])) == [{'id': ddo_sample['id']}]
+
+    assert es.count(QueryModel({'license': ['CC-BY']})) == 1
+    assert es.count(QueryModel({'license': ['MIT']})) == 0
+    assert es.count(QueryModel({'text': ['Weather']})) == 1
+    es.write({"value": "count"}, 'count1')
+    assert es.count() == 2
+    assert es.count(QueryModel({'text': ['Weather']})) == 1
+    for query in ({'text': ['Weather']}, {'text': ['Weather'], 'license': ['MIT']}):
+        assert es.count(QueryModel(dict(query))) == len(es.query(QueryModel(dict(query)))[0])
+    es.delete('count1')
+    objects, total = es.query(QueryModel({'license': ['CC-BY']}), track_total_hits=False)
+    assert objects[0]['id'] == ddo_sample['id']
+    assert total is None
+    if es.driver.cluster_version < 7:
+        with pytest.raises(ValueError):
+            es.query(QueryModel({'license': ['CC-BY']}), track_total_hits=100)
+
     search_model_dataToken = QueryModel({'dataToken': ['0x2eD6d94Ec5Af12C43B924572F9aFFe470DC83282']})
     assert len(es.query(search_model_dataToken)[0]) == 1
 
@@ -196,77 +454,171 @@ def test_full_text_query_tree():
 
 def test_query_parser():
     query = {'cost': ["0", "100"]}
-    assert query_parser(query) == ({"bool": {"must": [{"bool": {"should": [{"range": {"service.attributes.main.cost": {"gte": "0", "lte": "100"}}}]}}]}})
+    assert query_parser(query) == ({"bool": {"filter": [{"range": {"service.attributes.main.cost": {"gte": "0", "lte": "100"}}}]}})
 
     query = {'cost': ["15"]}
-    assert query_parser(query) == ({"bool": {"must": [{"bool": {"should": [{"match": {"service.attributes.main.cost": "15"}}]}}]}})
+    assert query_parser(query) == ({"bool": {"filter": [{"match": {"service.attributes.main.cost": "15"}}]}})
 
     query = {'license': ['CC-BY']}
-    assert query_parser(query) == ({"bool": {"must": [{"bool": {"should": [{"match": {"service.attributes.main.license": "CC-BY"}}]}}]}})
+    assert query_parser(query) == ({"bool": {"filter": [{"terms": {"service.attributes.main.license.keyword": ["CC-BY"]}}]}})
 
     query = {'metadata_type': ['dataset', 'algorithm']}
     assert query_parser(query) == ({
-        "bool": {"must": [{
-            "bool": {
-                "should": [
-                    {"match": {"service.attributes.main.type": "dataset"}},
-                    {"match": {"service.attributes.main.type": "algorithm"}}
-                ]}
-        }]}
+        "bool": {"filter": [
+            {"terms": {"service.attributes.main.type.keyword": ["dataset", "algorithm"]}}
+        ]}
     })
 
     query = {'type': ['Access', 'Metadata']}
-    assert query_parser(query) == ({"bool": {"must": [{"bool": {"should": [{"match": {"service.type": "Access"}}, {"match": {"service.type": "Metadata"}}]}}]}})
+    assert query_parser(query) == ({"bool": {"filter": [{"terms": {"service.type.keyword": ["Access", "Metadata"]}}]}})
 
     query = {'cost': ["0", "10"], 'type': ['Access', 'Metadata']}
     assert query_parser(query) == ({
             "bool": {
-                "must": [
-                    {"bool": {"should": [{"range": {"service.attributes.main.cost": {"gte": "0", "lte": "10"}}}]}},
-                    {"bool": {"should": [{"match": {"service.type": "Access"}}, {"match": {"service.type": "Metadata"}}]}}
+                "filter": [
+                    {"range": {"service.attributes.main.cost": {"gte": "0", "lte": "10"}}},
+                    {"terms": {"service.type.keyword": ["Access", "Metadata"]}}
                 ]
             }
     })
 
     query = {'license': []}
-    assert query_parser(query) == ({"bool": {"must": [{"bool": {"should": []}}]}})
+    assert query_parser(query) == ({"bool": {"filter": []}})
 
     query = {'license': [], 'type': ['Access', 'Metadata']}
     assert query_parser(query) == ({
         "bool": {
-            "must": [
-                {"bool": {"should": []}},
-                {"bool": {"should": [
-                    {"match": {"service.type": "Access"}},
-                    {"match": {"service.type": "Metadata"}}]}}
+            "filter": [
+                {"terms": {"service.type.keyword": ["Access", "Metadata"]}}
             ]}
     })
 
     query = {'license': ['CC-BY'], 'type': ['Access', 'Metadata']}
     assert query_parser(query) == ({
         "bool": {
-            "must": [
-                {"bool": {"should": [{"match": {"service.attributes.main.license": "CC-BY"}}]}},
-                {"bool": {"should": [
-                    {"match": {"service.type": "Access"}},
-                    {"match": {"service.type": "Metadata"}}]}}
+            "filter": [
+                {"terms": {"service.attributes.main.license.keyword": ["CC-BY"]}},
+                {"terms": {"service.type.keyword": ["Access", "Metadata"]}}
             ]}
     })
 
     query = {'license': ['CC-BY'], 'created': ['2016-02-07T16:02:20Z', '2016-02-09T16:02:20Z']}
-    assert query_parser(query)["bool"]["must"][1]["bool"]["should"][0]["range"]["created"]["gte"].year == 2016
+    assert query_parser(query)["bool"]["filter"][1]["range"]["created"]["gte"].year == 2016
 
     query = {'datePublished': ['2017-02-07T16:02:20Z', '2017-02-09T16:02:20Z']}
-    assert query_parser(query)["bool"]["must"][0]["bool"]["should"][0]["range"]["service.attributes.main.datePublished"]["gte"].year == 2017
+    assert query_parser(query)["bool"]["filter"][0]["range"]["service.attributes.main.datePublished"]["gte"].year == 2017
 
     query = {'categories': ['weather', 'other']}
-    assert query_parser(query) == ({"bool": {"must": [{"bool": {"should": [{"match": {"service.attributes.additionalInformation.categories": "weather"}}, {"match": {"service.attributes.additionalInformation.categories": "other"}}]}}]}})
+    assert query_parser(query) == ({"bool": {"filter": [{"terms": {"service.attributes.additionalInformation.categories.keyword": ["weather", "other"]}}]}})
+
+    query = {'text': ['weather'], 'license': ['CC-BY']}
+    assert query_parser(query) == ({
+        "bool": {
+            "filter": [{"terms": {"service.attributes.main.license.keyword": ["CC-BY"]}}],
+            "must": [{"bool": {"should": [
+                {"match": {"service.attributes.main.name": "weather"}},
+                {"match": {"service.attributes.additionalInformation.description": "weather"}}]}}]
+        }
+    })
 
     query = {'service.attributes.additionalInformation.customField': ['customValue']}
-    assert query_parser(query) == ({"bool": {"must": [{"bool": {"should": [{"match": {"service.attributes.additionalInformation.customField": "customValue"}}]}}]}})
+    assert query_parser(query) == ({"bool": {"filter": [{"bool": {"should": [{"match": {"service.attributes.additionalInformation.customField": "customValue"}}]}}]}})
 
     query = {'service.attributes.additionalInformation.customNumber': [2, 5]}
-    assert query_parser(query) == ({"bool": {"must": [{"bool": {"should": [{"range": {"service.attributes.additionalInformation.customNumber": {"gte": 2, "lte": 5}}}]}}]}})
+    assert query_parser(query) == ({"bool": {"filter": [{"range": {"service.attributes.additionalInformation.customNumber": {"gte": 2, "lte": 5}}}]}})
+
+
+def test_unknown_fields_reload_mapping(monkeypatch):
+    es.write({"value": "test"}, 'unknown1')
+    es._field_types(reload=True)
+    es.write({"value": "test", "freshField": "fresh"}, 'unknown2')
+    monkeypatch.setattr(es.driver, '_unknown_fields', 'reject')
+    assert es.query(QueryModel({'freshField': ['fresh']}))[0][0]['freshField'] == 'fresh'
+    with pytest.raises(ValueError):
+        es.query(QueryModel({'neverWrittenField': ['x']}))
+    es.delete('unknown1')
+    es.delete('unknown2')
+
+
+def test_query_parser_unknown_fields():
+    field_types = MappingCache()
+    field_types.load({'index': {'mappings': {'properties': {
+        'rating': {'type': 'float'},
+        'origin': {'type': 'keyword'},
+    }}}})
+    query = {'rating': ["0.5", "1"], 'origin': ['x']}
+    assert query_parser(query, field_types, 'reject') == ({"bool": {"filter": [
+        {"range": {"rating": {"gte": "0.5", "lte": "1"}}},
+        {"bool": {"should": [{"match": {"origin": "x"}}]}},
+    ]}})
+    assert query_parser({'service.attributes.main.cost': [5]}, field_types, 'reject') == (
+        {"bool": {"filter": [{"match": {"service.attributes.main.cost": 5}}]}})
+
+    query = {'color': ['red', 'blue']}
+    assert query_parser(query, field_types) == (
+        {"bool": {"filter": [{"bool": {"should": [{"match": {"color": "red"}}, {"match": {"color": "blue"}}]}}]}})
+    with pytest.raises(ValueError):
+        query_parser(query, field_types, 'reject')
+
+
+def test_query_templates():
+    query = {'license': ['CC-BY'], 'cost': ['0', '12'], 'sample': []}
+    shape = query_shape(query)
+    assert shape == (('cost', 'range'), ('license', 'terms'))
+    assert query_shape({'license': ['MIT'], 'cost': ['1', '2']}) == shape
+    assert query_shape({'cost': ['1', '2'], 'license': ['MIT']}) == shape
+    assert query_shape({'text': ['weather']}) is None
+    assert query_shape({'service.attributes.additionalInformation.customField': ['x']}) is None
+    assert '{{#toJson}}p0{{/toJson}}' in template_source(shape)
+    assert template_params(query, shape, [{'_id': 'asc'}], 2, 10) == {
+        'sort': [{'_id': 'asc'}], 'from': 10, 'size': 10, 'p0_gte': '0', 'p0_lte': '12', 'p1': ['CC-BY']}
+
+    es.write(ddo_sample, ddo_sample['id'])
+    es.driver._search_templates = True
+    try:
+        assert es.query(QueryModel(query))[0][0]['id'] == ddo_sample['id']
+        assert es.query(QueryModel({'license': ['CC-BY']}), fields=['id'])[0] == [{'id': ddo_sample['id']}]
+        es.driver.es.delete_script(id=template_id(shape))
+        assert es.query(QueryModel(query))[0][0]['id'] == ddo_sample['id']
+    finally:
+        es.driver._search_templates = False
+        es.delete(ddo_sample['id'])
+
+
+def test_log_slow_query(caplog):
+    body = {'query': {'match_all': {}}}
+    log_slow_query(0, body, {'took': 500})
+    log_slow_query(100, body, {'took': 50})
+    assert not caplog.records
+    log_slow_query(100, body, {'took': 150})
+    assert len(caplog.records) == 1
+    assert caplog.records[0].took == 150
+    assert caplog.records[0].body == body
+
+
+def test_facets():
+    aggs = facet_aggregations(['license', 'datePublished', 'cost'], size=5, ranges={'cost': [{'to': 10}]})
+    assert aggs == {
+        'license': {'terms': {'field': 'service.attributes.main.license.keyword', 'size': 5}},
+        'datePublished': {'date_histogram': {
+            'field': 'service.attributes.main.datePublished', 'interval': 'month', 'min_doc_count': 1}},
+        'cost': {'range': {'field': 'service.attributes.main.cost', 'ranges': [{'to': 10}]}},
+    }
+    with pytest.raises(ValueError):
+        facet_aggregations(['text'])
+    with pytest.raises(ValueError):
+        facet_aggregations(['cost'])
+    assert facet_results({'license': {'buckets': [{'key': 'CC-BY', 'doc_count': 2}]}}) == \
+        {'license': [{'key': 'CC-BY', 'count': 2}]}
+
+    es.write(ddo_sample, ddo_sample['id'])
+    results, total, facets = es.facets(QueryModel({'license': ['CC-BY']}), ['license', 'categories'])
+    assert results[0]['id'] == ddo_sample['id']
+    assert facets['license'] == [{'key': 'CC-BY', 'count': 1}]
+    results, _, facets = es.facets(QueryModel({}), ['license'], include_hits=False)
+    assert results == []
+    assert {'key': 'CC-BY', 'count': 1} in facets['license']
+    es.delete(ddo_sample['id'])
 
 
 def test_default_sort():
@@ -279,3 +631,60 @@ def test_default_sort():
     assert es.query(search_model)[0][0]['id'] == ddo_sample2['id']
     es.delete(ddo_sample['id'])
     es.delete(ddo_sample2['id'])
+
+
+def test_mapping_profiles():
+    assert mapping_profile() == json.loads(mapping)
+    lean = mapping_profile('lean')['mappings']['_doc']
+    assert lean['properties']['proof'] == {'type': 'object', 'enabled': False}
+    assert lean['properties']['@context']['index'] is False
+    assert lean['properties']['service']['properties']['attributes']['properties']['encryptedFiles'][
+        'doc_values'] is False
+    assert lean['dynamic_templates'][0]['strings']['mapping']['type'] == 'keyword'
+    with pytest.raises(ValueError):
+        mapping_profile('tiny')
+
+
+def test_mapping_cache():
+    cache = MappingCache(ttl=0)
+    assert cache.stale
+    cache.load({'oceandb_v1': {'mappings': {'_doc': {'properties': {
+        'price': {'properties': {'value': {'type': 'double'}}},
+        'name': {'type': 'text', 'fields': {'keyword': {'type': 'keyword'}}},
+    }}}}})
+    assert not cache.stale
+    assert cache.field_type('price') == 'object'
+    assert cache.field_type('price.value') == 'double'
+    assert cache.field_type('name.keyword') == 'keyword'
+    assert 'name' in cache
+    assert 'missing' not in cache
+    cache.invalidate()
+    assert cache.stale
+
+
+def test_query_cache():
+    cache = QueryCache(max_entries=2, ttl=60)
+    key = QueryCache.key({'query': {'match_all': {}}}, None)
+    assert key == QueryCache.key({'query': {'match_all': {}}}, None)
+    assert cache.get(key) is None
+    cache.put(key, ([{'value': 'test'}], 1))
+    result = cache.get(key)
+    assert result == [[{'value': 'test'}], 1]
+    result[0].append('mutated')
+    assert cache.get(key) == [[{'value': 'test'}], 1]
+    cache.put('b', 1)
+    cache.put('c', 2)
+    assert cache.get(key) is None
+    assert cache.stats() == {'hits': 2, 'misses': 2, 'entries': 2, 'bytes': 2}
+    generation = cache.generation
+    cache.clear()
+    assert cache.get('b') is None
+    cache.put('b', 1, generation)
+    assert cache.get('b') is None
+    cache.put('b', 1, cache.generation)
+    assert cache.get('b') == 1
+    assert not QueryCache().enabled
+
+    expired = QueryCache(max_entries=2, ttl=-1)
+    expired.put('a', 1)
+    assert expired.get('a') is None